@@ -4,15 +4,52 @@ last_update='2023-05-16'
 author='Damien Marsic, damien.marsic@aliyun.com'
 license='GNU General Public v3 (GPLv3)'
 
-import dmbiolib as dbl
-import argparse,sys,os,itertools,regex#### update!
+import argparse,sys,os,io,time,pickle,hashlib,itertools,importlib,types,json,stat,mmap,zlib,queue,threading,socket,contextlib,shutil,tempfile,logging
+import multiprocessing as mp
 from glob import glob
-import numpy as np
-from collections import defaultdict
-from matplotlib import pyplot as plt
-from matplotlib.backends.backend_pdf import PdfPages
+from concurrent.futures import ThreadPoolExecutor
+from collections import defaultdict,deque,namedtuple,OrderedDict
+from array import array
+
+class Lazy(types.ModuleType):
+    def __getattr__(self,k):
+        if k[:2]=='__':
+            raise AttributeError(k)
+        m=importlib.import_module(self.__name__)
+        for x,n in self.refs:
+            setattr(x,n,m)
+        return getattr(m,k)
+
+def import_deferred(name,*defer):
+    L={}
+    for n in defer:
+        x=n.rpartition('.')
+        if n not in sys.modules and (not x[0] or x[0] in L):
+            L[n]=sys.modules[n]=Lazy(n)
+            L[n].refs=[]
+            if x[0]:
+                setattr(L[x[0]],x[2],L[n])
+    try:
+        m=importlib.import_module(name)
+    finally:
+        for n in L:
+            if sys.modules.get(n) is L[n]:
+                del sys.modules[n]
+    for k,v in vars(m).items():
+        if isinstance(v,Lazy):
+            v.refs.append((m,k))
+    return m
+
+dbl=import_deferred('dmbiolib','numpy','matplotlib','matplotlib.pyplot')
 
 script=os.path.basename(__file__).split('.')[0]
+NT4=str.maketrans('acgt','0123')
+NT2=bytes([4]*97+[0,4,1,4,4,4,2]+[4]*12+[3]+[4]*139)
+COMP=bytes.maketrans(b'atgcnryswkmbdhv',b'tacgnyrswmkvhdb')
+_mm={}
+_lru={}
+RC=str.maketrans({chr(k):dbl.bpairs.get(chr(k),'X') for k in range(256)})
+Region=namedtuple('Region','i a b c left right P W compr ci ca cb cc cleft cright cP cW')
 
 def main():
     parser=argparse.ArgumentParser(description="Analysis of DNA barcode sequencing experiments. For full documentation, visit: https://"+script+".readthedocs.io")
@@ -21,13 +58,43 @@ def main():
     parser_a=subparser.add_parser('count',help="Count barcodes from read files")
     parser_a.add_argument('-c','--configuration_file',default=script+'_count.conf',type=str,help='Configuration file for the '+script+' count program (default: '+script+'_count.conf), will be created if absent')
     parser_a.add_argument('-n','--new',default=False,action='store_true',help="Create new configuration file and rename existing one")
+    parser_a.add_argument('-t','--threads','--workers',type=int,default=1,help="Number of worker processes used to process reads (default: 1)")
+    parser_a.add_argument('-r','--resume',default=False,action='store_true',help="Resume an interrupted run from the last checkpoint, skipping read files that were already processed")
+    parser_a.add_argument('-k','--checkpoint',type=float,default=10,help="Save a checkpoint allowing to resume an interrupted run every this many minutes (default: 10, 0: no checkpoint)")
+    parser_a.add_argument('--cache',type=str,default='',help="Directory in which barcode counts of each read file are cached, so that unchanged read files are not processed again if only definitions were changed (default: no cache)")
+    parser_a.add_argument('--cache_size',type=float,default=1000,help="Maximum size of the cache directory in MB, least recently used results are deleted first (default: 1000)")
+    parser_a.add_argument('-z','--inflate',type=int,default=2,help="Number of threads decompressing gzipped read files in BGZF format (as produced by bgzip), other gzipped files are decompressed by a single thread (default: 2)")
+    parser_a.add_argument('-p','--profile',default=False,action='store_true',help="Save time spent and number of reads in each processing stage into a json file next to the report file")
+    parser_a.add_argument('-b','--batch',type=int,nargs='?',const=1000000,default=0,help="Decode reads in batches of this size using NumPy, only reads that do not exactly match the template are processed one by one (default batch size if no value: 1000000)")
+    parser_a.add_argument('-d','--dedup',type=float,nargs='?',const=500,default=0,help="Collapse identical reads using a cache of decoded reads limited to this size in MB per worker process, so that each distinct read is decoded only once as long as it stays in the cache (default size if no value: 500)")
+    parser_a.add_argument('-m','--memo',type=float,nargs='?',const=100,default=0,help="Keep the barcodes found around each barcode location of reads that do not match the template exactly in a cache limited to this size in MB per worker process, so that barcodes in identical windows are only searched once (default size if no value: 100)")
+    parser_a.add_argument('-s','--shard',type=str,nargs='?',const='',default=None,help="Also save barcode counts of each read file, error correction counters and numbers of reads into a shard file that can be merged with shards from other runs using "+script+" merge (default file name if no value: project name followed by _count_shard.bsq)")
+    parser_a.add_argument('--spool',type=str,default='',help="Split read files into tasks saved into this directory, and have them processed by worker processes that can also be started on other computers sharing the directory with "+script+" worker (-t sets the number of local workers, 0 for none)")
+    parser_a.add_argument('--task_size',type=float,default=64,help="Size in MB of the parts of uncompressed read files processed by each task with --spool, gzipped files are processed as a single task (default: 64)")
+    parser_a.add_argument('--claim_timeout',type=float,default=10,help="With --spool, tasks claimed by a worker that did not report progress for this many minutes are returned to the spool directory, as are tasks claimed by workers that no longer run on this computer (default: 10, 0: no time limit)")
+    parser_b=subparser.add_parser('merge',help="Merge count shards into count results")
+    parser_b.add_argument('shards',nargs='+',type=str,help="Shard files saved by "+script+" count -s")
+    parser_b.add_argument('-p','--project',type=str,default='',help="Project name used for the merged count files (default: project name of the first shard)")
+    parser_d=subparser.add_parser('worker',help="Process tasks from the spool directory of a count run")
+    parser_d.add_argument('spool',type=str,help="Spool directory (--spool argument of "+script+" count)")
+    parser_d.add_argument('-z','--inflate',type=int,default=2,help="Number of threads decompressing gzipped read files in BGZF format (default: 2)")
     parser_c=subparser.add_parser('analyze',help="Analyze data")
     parser_c.add_argument('-c','--configuration_file',default=script+'_analyze.conf',type=str,help="Configuration file for the "+script+" analyze program (default: "+script+"_analyze.conf), will be created if absent")
     parser_c.add_argument('-n','--new',default=False,action='store_true',help="Create new configuration file and rename existing one")
     parser_c.add_argument('-f','--file_format',type=str,default='Single multipage pdf',help="Save each figure in separate file with choice of format instead of the default single multipage pdf file. Choices: svg, png, jpg, pdf, ps, eps, pgf, raw, rgba, tif")
+    parser_c.add_argument('-t','--threads',type=int,default=1,help="Number of processes rendering figures, figures saved into a single multipage pdf file are only rendered in parallel if the pypdf package is installed (default: 1)")
+    parser_c.add_argument('--no-plots','--csv-only',dest='plots',default=True,action='store_false',help="Only save results into csv files, without rendering any figure")
+    parser_c.add_argument('--large',type=int,default=300,help="Maximum number of bars, tick labels or legend entries drawn individually: larger figures are drawn as rasterized collections, with at most 50 tick labels and without legend, so that drawing time and pdf file size remain limited (default: 300, 0: no limit)")
+    parser_c.add_argument('--top',type=int,default=0,help="Only show in figures this number of variants with the highest values, all other variants being averaged as a single variant named others (csv files still contain all variants, default: 0, all variants)")
+    parser_c.add_argument('--cache',type=str,default='',help="Directory in which figures and csv files are cached, so that only those whose data or settings changed are created again (default: no cache)")
+    parser_c.add_argument('--cache_size',type=float,default=1000,help="Maximum size of the cache directory in MB, least recently used files are deleted first (default: 1000)")
     args=parser.parse_args()
     if args.command=='count':
         count(args)
+    if args.command=='merge':
+        merge(args)
+    if args.command=='worker':
+        worker(args)
     if args.command=='analyze':
         analyze(args)
 
@@ -73,11 +140,16 @@ def count(args):
             proj=ln
         if read=='rfiles':
             x=ln.split()
-            fail+=dbl.check_read_file(x[-1])
+            if not is_stream(x[-1]):
+                fail+=dbl.check_read_file(x[-1])
+            elif x[-1]=='-' and '-' in [k[1] for k in rfiles]:
+                fail+='\n  Standard input (-) can only be used once under READ FILES!'
             if len(x)>2:
                 fail+='\n  Too many items per line under READ FILES! Each line must contain a prefix followed by a single file name (merged reads if paired-end sequencing), separated by space or tab!'
             if len(x)==1:
                 z=dbl.prefix([x[0]])[0]
+                if x[0]=='-':
+                    z='stdin'
                 x.insert(0,z)
             if x[0] in [k[0] for k in rfiles]:
                 fail+='\n  Duplicate prefix '+x[0]+' found under READ FILES! Each line must contain a different prefix!'
@@ -133,6 +205,9 @@ def count(args):
     f.close()
     rname=proj+'_count_report.txt'
     dbl.rename(rname)
+    if args.shard is not None:
+        args.shard=args.shard or proj+'_count_shard.bsq'
+        dbl.rename(args.shard)
     print('\n  Checking configuration... ',end='')
     if not proj:
         fail+='\n  Project name is missing!'
@@ -255,6 +330,7 @@ def count(args):
             bcr[n].append(True)
         else:
             bcr[n].append(False)
+    BCI={n:neighbours(BC[n]) if bcr[n][1] else {} for n in BC}
     dr=sorted(set([tuple(set([bc[n][1] for n in k])) for k in defn.values()]))
     for n in bcr:
         if len([m for k in dr for m in k if m==n])>1:
@@ -282,47 +358,47 @@ def count(args):
     ### Check read file(s) ###
     fail=''
     print('OK\n\n  Checking read files...    ',end='')
+    lpmet=dbl.revcomp(templ)
     for j in range(len(rfiles)):
-        nr=dbl.readcount(rfiles[j][1])
-        rfiles[j].append(nr)
-        if nr<100:
-            fail+='\n  Number of reads in '+rfiles[j][0]+' is too low!'
-        f,step=dbl.initreadfile(rfiles[j][1])
+        if is_stream(rfiles[j][1]):
+            f,step=stream_open(rfiles[j][1])
+        else:
+            f,step=dbl.initreadfile(rfiles[j][1])
         c=0
         a=0
         b=0
-        lpmet=dbl.revcomp(templ)
+        x=[]
         while c<200:
             l,f,c,_=dbl.getread(f,step,c)
+            if not l:
+                break
+            x.append(l)
             d=min(30,len(l))
             if dbl.match(l[:d],templ[:d]):
                 a+=1
                 continue
             if dbl.match(l[:d],lpmet[:d]):
                 b+=1
-        f.close()
-        x='+'
+        y='+'
         if b and not a:
-            x='-'
+            y='-'
         elif b and a:
-            x='Both'
+            y='Both'
         elif not a and not b:
-            x='None'
+            y='None'
             fail+='\n  Read file '+rfiles[j][1]+' does not contain sequences matching the template sequence!'
-        rfiles[j].append(x)
-    r=open(rname,'w')
+        rfiles[j].extend([None,y,f,step,x])
     if fail:
+        for n in rfiles:
+            n[4].close()
+        r=open(rname,'w')
         dbl.pr2(r,'Problems found!\n'+fail+'\n')
-    else:
-        print('OK\n')
-    ### Display settings ###
-    dbl.pr2(r,'  Read file prefix         Read file                     Number of reads    Read orientation')
-    for n in rfiles:
-        dbl.pr2(r,'  '+n[0].ljust(25)+n[1].ljust(30)+f'{n[2]:,}'.rjust(15)+n[3].center(24))
-    dbl.pr2(r,'')
-    if fail:
+        rfile_table(r,rfiles)
         r.close()
         sys.exit()
+    print('OK\n')
+    ### Display settings ###
+    r=io.StringIO()
     dbl.pr2(r,'  Template sequence:\n'+dbl.format_dna(templ,2,80,10))
     if bc:
         x={k:[(n,bc[n][0]) for n in bc if bc[n][1]==k] for k in bcr}
@@ -358,72 +434,154 @@ def count(args):
         cbcr[i].append(i+cbcr[i][0])
         cbcr[i].append(min(len(ctempl),i+cbcr[i][0]+probe))
     counts=defaultdict(int)
-    ec=[0,0,0,0,0]  # alternate position, compressed mode, compressed mode + alternate position, barcode single substitution, corrected reads
+    ec=[0,0,0,0,0,0,0,0,0,0,0,0,0]  # alternate position, compressed mode, compressed mode + alternate position, barcode single substitution, corrected reads, forward strand reads, reverse strand reads, reads found in read cache, reads looked up in read cache, read cache peak memory, windows found in window cache, windows looked up in window cache, window cache peak memory
     C=0
+    pos=list(bcr)
+    sh=[0]
+    for n in pos:
+        sh.append(sh[-1]+2*bcr[n][0]+2)
+    BCc=[{pack(k):BC[n][k] for k in BC[n]} if n in BC else {} for n in pos]
+    BCIc=[{pack(k):pack(BCI[n][k]) if BCI[n][k] else None for k in BCI[n]} if n in BCI else {} for n in pos]
+    DEFc={n:{tuple([pack(bc[m][0]) for m in k]):DEF[n][k] for k in DEF[n]} for n in DEF}
+    settings=(templ,regions(templ,bcr,ctempl,cbcr),strand_signature(templ),BCc,BCIc,sh)
+    ck=proj+'_count_checkpoint.pkl'
+    dg=digest(settings,[k[:2]+list(file_id(k[1])) for k in rfiles])
+    cd=digest(__version__,templ,bcr,probe,[sorted(k) for k in BCc],len(ec))
+    dd=int(args.dedup*1048576)
+    dm=int(args.memo*1048576)
+    state=None
+    if args.resume:
+        state=load_checkpoint(ck,dg)
+    done=[]
+    saved=[]
+    if state:
+        saved=state['files']
+    tc=time.time()
+    pr=None
+    if args.profile:
+        pr={}
+        pf=[]
+        ts=time.perf_counter()
+    pool=None
+    if args.threads>1 and not args.spool:
+        pool=mp.Pool(args.threads,initializer=init_worker,initargs=(settings,))
+    S=None
+    if args.spool:
+        S=spool(args.spool,rfiles,settings,dg,args)
     ### Process read file(s) ###
-    for rfile in rfiles:
+    for j in range(len(rfiles)):
+        rfile=rfiles[j]
         print()
-        f,step=dbl.initreadfile(rfile[1])
-        t='Processing reads from '+rfile[1]+'...'
-        show=dbl.progress_start(rfile[2],t)
+        f,step,x=rfile[4:]
+        T=Counts()
+        E=[0]*len(ec)
         c=0
-        compr=True in [bcr[k][2] for k in bcr]
-        while True:
-            X1=X2=None
-            p1=p2=0
-            l,f,c,_=dbl.getread(f,step,c)
-            if not l:
-                break
-            cl=''
-            if compr:
-                cl=dbl.compress(l)
-            if rfile[3]!='-':
-                X1,p1,ec1=find_bc(l,templ,bcr,cl,ctempl,cbcr)
-            if rfile[3]!='+':
-                X2,p2,ec2=find_bc(dbl.revcomp(l),templ,bcr,cl,ctempl,cbcr)
-            if X1 and (not X2 or (X2 and p2>p1)):
-                X=X1
-                EC=ec1
-                p=p1
-            elif X2 and (not X1 or (X1 and p1>p2)):
-                X=X2
-                EC=ec2
-                p=p2
+        rfile[2]=0
+        y=False
+        key=None
+        st=0
+        t0=time.perf_counter()
+        if args.cache and not isinstance(f,Stream):
+            key=digest(cd,file_hash(rfile[1],args.cache))
+        if j<len(saved) and (saved[j][3] or not isinstance(f,Stream)):
+            (T.ids,T.n),rfile[2],fp,y,E,c=saved[j]
+            if y:
+                print('  Reads from '+rfile[1]+' were already processed (resumed from '+ck+')')
             else:
-                continue
-            C+=1
-            for i in range(len(EC)):
-                ec[i]+=EC[i]
-            for i in X:
-                if bcr[i][1] and X[i] not in BC[i]:
-                    for n in BC[i]:
-                        if dbl.diff((X[i],n))==1:
-                            X[i]=n
-                            ec[3]+=1
-                            p+=1
-                            break
-                if X[i] in BC[i]:
-                    X[i]=BC[i][X[i]]
-            if p:
-                ec[4]+=1
-            Y=''
-            if len(rfiles)>1:
-                Y=rfile[0]
-            for n in dr:
-                x=[]
-                for m in n:
-                    x.append(X[m])
-                x=tuple(x)
-                if Y:
-                    Y+=','
-                if x in DEF[n]:
-                    Y+=DEF[n][x]
-                else:
-                    Y+=','.join(x)
-            counts[Y]+=1
-            dbl.progress_check(c,show,t)
-        dbl.progress_end()
+                st=fp
+                x=None
+                print('  Resuming '+rfile[1]+' from checkpoint '+ck)
+        elif S:
+            (T.ids,T.n),rfile[2],E,c=S[j]
+            y=True
+            print('  Results for '+rfile[1]+' were received from spool directory '+args.spool)
+        elif key:
+            z=cache_load(args.cache,key)
+            if z:
+                (T.ids,T.n),rfile[2],E,c=z
+                y=True
+                print('  Results for '+rfile[1]+' were loaded from cache directory '+args.cache)
+        u=not y
+        if u:
+            t='Processing reads from '+rfile[1]+'...'
+            fp=None
+            if not isinstance(f,Stream):
+                fp=deque()
+            if fp is None:
+                chunks=read_chunks(f,step,t,x,args.batch or 10000,pr)
+            elif rfile[1][-2:]=='gz':
+                chunks=gz_chunks(rfile[1],step,t,st,args.batch or 10000,fp,pr,args.inflate,2*args.threads+2)
+            else:
+                chunks=mmap_chunks(rfile[1],step,t,st,args.batch or 10000,fp)
+            if pool:
+                results=pool_map(pool,chunks,rfile[3],bool(args.batch),args.profile,2*args.threads,dd,dm)
+            else:
+                results=(range_count(k,rfile[3],settings,bool(args.batch),args.profile,dd,dm) for k in chunks)
+            for x,y,z,nr,w in results:
+                t1=time.perf_counter()
+                T.merge(x)
+                add_ec(E,y)
+                c+=z
+                rfile[2]+=nr
+                if w:
+                    for k in w:
+                        tick(pr,k,w[k][1],w[k][0])
+                    tick(pr,'Merging',time.perf_counter()-t1,len(x))
+                if fp is None:
+                    continue
+                y=fp.popleft()
+                if args.checkpoint and time.time()-tc>args.checkpoint*60:
+                    save_checkpoint(ck,{'digest':dg,'files':done+[[(T.ids,T.n),rfile[2],y,False,E,c]]})
+                    tc=time.time()
+            if fp is None:
+                print('\n')
+            else:
+                dbl.progress_end()
+            if key:
+                cache_save(args.cache,key,[(T.ids,T.n),rfile[2],E,c],args.cache_size)
         f.close()
+        mmap_close(rfile[1])
+        done.append([(T.ids,T.n),rfile[2],None,True,E,c])
+        if args.checkpoint:
+            save_checkpoint(ck,{'digest':dg,'files':done})
+        add_ec(ec,E)
+        C+=c
+        if rfile[2]<100:
+            fail+='\n  Number of reads in '+rfile[0]+' is too low!'
+        pre=''
+        if len(rfiles)>1:
+            pre=rfile[0]
+        t1=time.perf_counter()
+        for n,m in map_counts(T,pre,pos,sh,BCc,dr,DEFc):
+            counts[n]+=m
+        if pr is not None:
+            tick(pr,'Definition mapping',time.perf_counter()-t1,len(T))
+            pf.append({'file':rfile[1],'reads':rfile[2],'successful reads':c,'processed':u,'time':time.perf_counter()-t0})
+    if pool:
+        pool.close()
+        pool.join()
+    if os.path.exists(ck):
+        os.remove(ck)
+    x=r.getvalue()
+    count_save(proj,x,rfiles,fail,counts,C,ec,DEF,args.dedup,args.memo,len(templ))
+    if args.shard is not None:
+        data_save(args.shard,{'shard':1,'version':__version__,'digest':digest(templ,bcr,probe,[sorted(k) for k in BCc],DEFc),'project':proj,'settings':x,'map':(pos,sh,BCc,dr,DEFc),'DEF':DEF,'dedup':args.dedup,'memo':args.memo,'tlen':len(templ),'files':[k[:4]+[list(n[0][0])]+n[4:] for k,n in zip(rfiles,done)]},{str(i):done[i][0][1] for i in range(len(done))})
+        print('  Shard was saved into file: '+args.shard+'\n')
+    if pr is not None:
+        x=['Alternate position','Indel within homopolymer in probe','Alternate position + indel','Nucleotide substitution','Error-corrected reads','Forward strand','Reverse strand','Read cache hits','Read cache lookups','Read cache peak memory','Window cache hits','Window cache lookups','Window cache peak memory']
+        y={'threads':args.threads,'batch':args.batch,'dedup':args.dedup,'memo':args.memo,'files':pf,'counters':{**{x[i]:ec[i] for i in range(len(ec))},'Successful reads':C}}
+        profile_save(proj+'_count_profile.json',pr,time.perf_counter()-ts,sum([k['reads'] for k in pf]),y)
+
+def count_save(proj,x,rfiles,fail,counts,C,ec,DEF,dedup=0,memo=0,tlen=0):
+    rname=proj+'_count_report.txt'
+    r=open(rname,'w')
+    if fail:
+        dbl.pr2(r,'Problems found!\n'+fail+'\n')
+        rfile_table(r,rfiles)
+        r.close()
+        sys.exit()
+    rfile_table(r,rfiles)
+    r.write(x)
     ### Display result summary ###
     x=[DEF[k].values() for k in DEF]
     y=0
@@ -442,11 +600,331 @@ def count(args):
     dbl.pr2(r,'  Indel within homopolymer in probe:'.ljust(40)+f'{ec[1]:,}'.rjust(15))
     dbl.pr2(r,'  Alternate position + indel:'.ljust(40)+f'{ec[2]:,}'.rjust(15))
     dbl.pr2(r,'  Nucleotide substitution:'.ljust(40)+f'{ec[3]:,}'.rjust(15))
+    dbl.pr2(r,'\n  Strand of successful reads:')
+    dbl.pr2(r,'  Forward:'.ljust(40)+f'{ec[5]:,}'.rjust(15))
+    dbl.pr2(r,'  Reverse:'.ljust(40)+f'{ec[6]:,}'.rjust(15))
+    if dedup:
+        dbl.pr2(r,'\n  Read cache (limited to '+f'{dedup:g}'+' MB per process):')
+        dbl.pr2(r,'  Reads looked up:'.ljust(40)+f'{ec[8]:,}'.rjust(15))
+        dbl.pr2(r,'  Reads found in cache:'.ljust(40)+f'{ec[7]:,}'.rjust(15)+' ('+f'{ec[7]/max(ec[8],1)*100:.2f}'.rjust(6)+'% hit rate)')
+        dbl.pr2(r,'  Peak memory used (MB):'.ljust(40)+f'{ec[9]/1048576:,.1f}'.rjust(15))
+    if memo:
+        dbl.pr2(r,'\n  Window cache (limited to '+f'{memo:g}'+' MB per process):')
+        dbl.pr2(r,'  Windows looked up:'.ljust(40)+f'{ec[11]:,}'.rjust(15))
+        dbl.pr2(r,'  Windows found in cache:'.ljust(40)+f'{ec[10]:,}'.rjust(15)+' ('+f'{ec[10]/max(ec[11],1)*100:.2f}'.rjust(6)+'% hit rate)')
+        dbl.pr2(r,'  Peak memory used (MB):'.ljust(40)+f'{ec[12]/1048576:,.1f}'.rjust(15))
     dbl.csv_write(proj+'_count.csv',None,counts,None,'Barcode distribution',r)
     r.close()
+    if tlen:
+        defn=[]
+        for n in DEF:
+            for m in DEF[n].values():
+                if [list(n),m] not in defn:
+                    defn.append([list(n),m])
+        count_bin(proj+'_count.csv',counts,{'tlen':tlen,'defn':defn,'rfp':[k[0] for k in rfiles]})
     print('\n  Report was saved into file: '+rname+'\n')
 
+def count_bin(fname,counts,meta):
+    N={}
+    I=array('q')
+    L=array('q')
+    for n in counts:
+        x=n.split(',')
+        I.extend([N.setdefault(k,len(N)) for k in x])
+        L.append(len(x))
+    x=os.stat(fname)
+    meta={'csv':fname,'size':x.st_size,'mtime':x.st_mtime_ns,'names':list(N),**meta}
+    y=fname[:-4]+'.bsq'
+    data_save(y,meta,{'ids':small_array(I),'lengths':small_array(L),'counts':small_array(counts.values())})
+    print('\n  Binary count table saved into file: '+y)
+
+def small_array(x):
+    x=array('q',x)
+    m=max(x,default=0)
+    return array([k for k in 'BHILQ' if m<256**array(k).itemsize][0],x)
+
+def load_bin(fname,csv=''):
+    if not os.path.isfile(fname):
+        return None
+    try:
+        meta,A=data_load(fname)
+        x=os.stat(csv or meta['csv'])
+    except (OSError,EOFError,ValueError,KeyError,TypeError):
+        return None
+    if (x.st_size,x.st_mtime_ns)!=(meta['size'],meta['mtime']):
+        return None
+    return A,meta
+
+def count_table(fname):
+    import numpy as np
+    x=load_bin(fname[:-4]+'.bsq',fname) if fname[-4:]=='.csv' else None
+    if x:
+        A,meta=x
+        z={k:np.frombuffer(A[k],dtype=A[k].typecode).astype(np.int64) for k in A}
+        return meta['names'],z['ids'],np.concatenate([[0],np.cumsum(z['lengths'])]).astype(np.int64),z['counts']
+    N={}
+    I=[]
+    O=[0]
+    C=[]
+    with open(fname,'r') as f:
+        for l in f:
+            l=l.strip().split(',')
+            if len(l)<2:
+                continue
+            I.extend([N.setdefault(k,len(N)) for k in l[:-1]])
+            O.append(len(I))
+            C.append(int(l[-1]))
+    return list(N),np.array(I,dtype=np.int64),np.array(O,dtype=np.int64),np.array(C,dtype=np.int64)
+
+def spool(d,rfiles,settings,dg,args):
+    for n in rfiles:
+        if is_stream(n[1]):
+            print('\n  Standard input and named pipes cannot be processed through a spool directory!\n')
+            sys.exit()
+    for n in ('tasks','claimed','results'):
+        os.makedirs(os.path.join(d,n),exist_ok=True)
+    x=os.path.join(d,'settings.bsq')
+    y=None
+    if os.path.isfile(x):
+        y=data_load(x)[0]
+    if not y or y['digest']!=dg:
+        spool_clear(d,False)
+        templ,R=settings[:2]
+        data_save(x,{'digest':dg,'settings':(templ,tuple([tuple(k) for k in R]))+settings[2:],'batch':args.batch,'dedup':int(args.dedup*1048576),'memo':int(args.memo*1048576)})
+    else:
+        for n in os.listdir(os.path.join(d,'claimed')):
+            os.replace(os.path.join(d,'claimed',n),os.path.join(d,'tasks',n[:n.find('.bsq')+4]))
+    N=[]
+    for j in range(len(rfiles)):
+        fname,ori,step=rfiles[j][1],rfiles[j][3],rfiles[j][5]
+        N.append([])
+        if fname[-2:]=='gz':
+            x=[(0,None)]
+        else:
+            m=mmap_open(fname)
+            x=[]
+            a=0
+            while a<len(m):
+                b=record_start(m,a+max(1,int(args.task_size*1048576)),step)
+                x.append((a,b))
+                a=b
+        for k in range(len(x)):
+            n=f'{j:04d}_{k:06d}.bsq'
+            N[-1].append(n)
+            if not os.path.isfile(os.path.join(d,'results',n)) and not os.path.isfile(os.path.join(d,'tasks',n)):
+                data_save(os.path.join(d,'tasks',n),{'digest':dg,'file':os.path.abspath(fname),'range':x[k],'step':step,'ori':ori})
+    P=[]
+    t='Processing reads through spool directory '+d+'...'
+    n=sum([len(k) for k in N])
+    print('  '+t+'     0.0%',end='')
+    while True:
+        y=os.listdir(os.path.join(d,'tasks'))
+        z=os.listdir(os.path.join(d,'claimed'))
+        x=len([k for k in os.listdir(os.path.join(d,'results')) if k[-4:]=='.bsq'])
+        k=str(round(x/max(n,1)*100,1))
+        print('\r  '+t+' '*(8-len(k))+k+'%',end='')
+        if x>=n:
+            break
+        if [p for p in P if p.exitcode]:
+            print('\n\n  A local worker failed! Fix the problem and run the same command again to process the remaining tasks.\n')
+            sys.exit()
+        if not y and not z:
+            print('\n\n  Some tasks are missing from the spool directory! Run the same command again to process the remaining tasks.\n')
+            sys.exit()
+        if spool_requeue(d,z,args.claim_timeout) or y:
+            for i in range(args.threads-len([p for p in P if p.exitcode is None])):
+                P.append(mp.Process(target=spool_worker,args=(d,args.inflate,True)))
+                P[-1].start()
+        time.sleep(0.2)
+    for p in P:
+        p.join()
+    dbl.progress_end()
+    S=[]
+    for j in range(len(N)):
+        T=Counts()
+        E=None
+        c=0
+        nr=0
+        for n in N[j]:
+            x,A=data_load(os.path.join(d,'results',n))
+            y=Counts()
+            y.ids,y.n=dict(zip(x['keys'],range(len(x['keys'])))),A['n']
+            T.merge(y)
+            if E is None:
+                E=x['ec']
+            else:
+                add_ec(E,x['ec'])
+            c+=x['successful']
+            nr+=x['reads']
+        S.append([(T.ids,T.n),nr,E,c])
+    spool_clear(d,True)
+    return S
+
+def spool_requeue(d,L,timeout):
+    h=socket.gethostname()
+    c=0
+    for n in L:
+        z=os.path.join(d,'claimed',n)
+        x=n[n.find('.bsq')+5:].rpartition('-')
+        try:
+            if (x[0]!=h or pid_alive(int(x[2]))) and (not timeout or time.time()-os.path.getmtime(z)<timeout*60):
+                continue
+            os.replace(z,os.path.join(d,'tasks',n[:n.find('.bsq')+4]))
+            c+=1
+        except (OSError,ValueError):
+            continue
+    return c
+
+def pid_alive(pid):
+    if os.name!='posix':
+        return True
+    try:
+        os.kill(pid,0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass
+    return True
+
+def spool_clear(d,settings):
+    for n in ('tasks','claimed','results'):
+        for m in glob(os.path.join(d,n,'*.bsq*')):
+            os.remove(m)
+        if settings:
+            os.rmdir(os.path.join(d,n))
+    if settings:
+        os.remove(os.path.join(d,'settings.bsq'))
+
+def spool_worker(d,inflate=2,quiet=False):
+    if quiet:
+        sys.stdout=open(os.devnull,'w')
+    dg=None
+    c=0
+    while True:
+        L=sorted(os.listdir(os.path.join(d,'tasks')))
+        if not L:
+            break
+        for n in L:
+            z=os.path.join(d,'claimed',n+'.'+socket.gethostname()+'-'+str(os.getpid()))
+            try:
+                os.rename(os.path.join(d,'tasks',n),z)
+                os.utime(z)
+            except OSError:
+                continue
+            w=data_load(z)[0]
+            if w['digest']!=dg:
+                y=data_load(os.path.join(d,'settings.bsq'))[0]
+                if y['digest']!=w['digest']:
+                    os.remove(z)
+                    continue
+                dg=y['digest']
+                templ,R=y['settings'][:2]
+                settings=(templ,tuple([Region(*k) for k in R]))+y['settings'][2:]
+            fname=w['file']
+            step=w['step']
+            t='Processing '+n+' ('+fname+')...'
+            if fname[-2:]=='gz':
+                chunks=gz_chunks(fname,step,t,0,y['batch'] or 10000,None,None,inflate)
+            else:
+                a,b=w['range']
+                chunks=mmap_chunks(fname,step,t,a,y['batch'] or 10000,None,b)
+            T=Counts()
+            E=None
+            C=0
+            N=0
+            for k in chunks:
+                x,e,m,nr,_=range_count(k,w['ori'],settings,bool(y['batch']),False,y['dedup'],y['memo'])
+                T.merge(x)
+                if E is None:
+                    E=e
+                else:
+                    add_ec(E,e)
+                C+=m
+                N+=nr
+                try:
+                    os.utime(z)
+                except OSError:
+                    pass
+            dbl.progress_end()
+            mmap_close(fname)
+            data_save(os.path.join(d,'results',n),{'keys':list(T.ids),'ec':E or [0]*13,'successful':C,'reads':N},{'n':T.n})
+            try:
+                os.remove(z)
+            except OSError:
+                pass
+            c+=1
+    return c
+
+def worker(args):
+    if not os.path.isfile(os.path.join(args.spool,'settings.bsq')):
+        print('\n  Spool directory '+args.spool+' not found or not ready!\n')
+        sys.exit()
+    c=spool_worker(args.spool,args.inflate)
+    print('\n  '+str(c)+' tasks processed, no task left in spool directory '+args.spool+'\n')
+
+def merge(args):
+    fail=''
+    S=None
+    F={}
+    dd=dm=tl=0
+    for fname in args.shards:
+        if not dbl.check_file(fname,False):
+            fail+='\n  Shard file '+fname+' not found!'
+            continue
+        try:
+            x,A=data_load(fname)
+        except (OSError,EOFError,ValueError,KeyError,TypeError):
+            x=None
+        if type(x) is not dict or x.get('shard')!=1:
+            fail+='\n  File '+fname+' is not a shard saved by '+script+' count!'
+            continue
+        if S is None:
+            S=x
+        elif x['digest']!=S['digest']:
+            fail+='\n  Shard file '+fname+' was created with a different template, barcodes or definitions than '+args.shards[0]+'!'
+            continue
+        print('\n  Merging '+fname+'...')
+        dd=max(dd,x['dedup'])
+        dm=max(dm,x['memo'])
+        tl=max(tl,x.get('tlen',0))
+        for i,(pre,name,n,ori,ids,E,c) in enumerate(x['files']):
+            if pre not in F:
+                F[pre]=[pre,name,0,ori,Counts(),[0]*len(E),0]
+            y=F[pre]
+            if name not in y[1].split(','):
+                y[1]+=','+name
+            if ori not in y[3].split(','):
+                y[3]+=','+ori
+            y[2]+=n
+            T=Counts()
+            T.ids,T.n=dict(zip(ids,range(len(ids)))),A[str(i)]
+            y[4].merge(T)
+            add_ec(y[5],E)
+            y[6]+=c
+    if fail:
+        print('\n  Problems found!\n'+fail+'\n')
+        sys.exit()
+    proj=args.project or S['project']
+    dbl.rename(proj+'_count_report.txt')
+    pos,sh,BCc,dr,DEFc=S['map']
+    counts=defaultdict(int)
+    ec=[0]*len(S['files'][0][5])
+    C=0
+    rfiles=list(F.values())
+    for rfile in rfiles:
+        add_ec(ec,rfile[5])
+        C+=rfile[6]
+        if rfile[2]<100:
+            fail+='\n  Number of reads in '+rfile[0]+' is too low!'
+        pre=''
+        if len(rfiles)>1:
+            pre=rfile[0]
+        for n,m in map_counts(rfile[4],pre,pos,sh,BCc,dr,DEFc):
+            counts[n]+=m
+    count_save(proj,S['settings'],rfiles,fail,counts,C,ec,S['DEF'],dd,dm,tl)
+
 def analyze(args):
+    import numpy as np
     ### Create configuration file if needed ###
     cf=args.configuration_file
     if args.new:
@@ -516,7 +994,7 @@ def analyze(args):
                 fail+='\n  Only one file should be listed under BARCODE COUNT FILE!'
             elif dbl.check_file(ln,False):
                 proj=ln[:ln.rfind('_count')]
-                _,bcount=dbl.csv_read(ln,False,None)
+                bcount=count_table(ln)
             else:
                 fail+='\n  Barcode count file '+ln+' not found!'
         if read=='variants':
@@ -648,109 +1126,96 @@ def analyze(args):
         if hcmap[i].lower()=='default':
             hcmap[i]=['seismic','hot_r'][i]
     pre=proj+'_'+str(thr)+'_'+str(int(xaxis))+'_'
-    if format:
-        mppdf=''
+    fname=None
+    if format or not args.plots:
         print()
     else:
         fname=pre+'figs.pdf'
         dbl.rename(fname)
-        mppdf=PdfPages(fname)
+    J=[]
     V.sort()
-    M={}
+    ### Load barcode counts into a samples x variants matrix ###
+    Vi={V[i]:i for i in range(len(V))}
+    Si={}
+    for i,n in enumerate(S):
+        Si.setdefault(frozenset(S[n]),i)
+    m=frozenset(mix.split(','))
+    BC=np.ones((len(S),len(V)),dtype=np.int64)
+    M=np.zeros(len(V),dtype=np.int64)
+    N,I,O,Q=bcount
+    del bcount
+    L=np.diff(O)
+    v=np.array([Vi.get(k,-1) for k in N],dtype=np.int64)
+    e=np.flatnonzero(v[I]>=0)
+    r,j=np.unique(np.repeat(np.arange(len(L)),L)[e],return_index=True)
+    j=e[j]-O[r]
+    R=[]
+    for l in np.unique(L[r]):
+        k=L[r]==l
+        P=I[O[r[k]][:,None]+np.arange(l)]
+        q=P[np.arange(len(P)),j[k]]
+        P[P==q[:,None]]=-1
+        U,i=np.unique(np.sort(P,axis=1),axis=0,return_inverse=True)
+        U=[frozenset(N[n] for n in u if n>=0) for u in U]
+        R.append((r[k],v[q],np.array([Si.get(u,-1) for u in U])[i.ravel()],np.array([bool(mix) and u==m for u in U])[i.ravel()]))
+    if R:
+        r,q,i,x=[np.concatenate(k) for k in zip(*R)]
+        k=np.argsort(r,kind='stable')[::-1]
+        r,q,i,x=r[k],q[k],i[k],x[k]
+        _,k=np.unique(q[x],return_index=True)
+        M[q[x][k]]=Q[r[x][k]]
+        y=i>=0
+        _,k=np.unique(i[y]*len(V)+q[y],return_index=True)
+        BC[i[y][k],q[y][k]]=Q[r[y][k]]
     ### Plot variant mix composition if variant mix exists ###
     if mix:
-        M={n:0 for n in V}
-        m=set(mix.split(','))
-        for n in bcount:
-            for q in n[:-1]:
-                if q in V:
-                    x=set(k for k in n[:-1] if k!=q)
-                    break
-            else:
-                continue
-            if x==m:
-                M[q]=int(n[-1])
-        x=sum(M.values())
-        q={n:M[n]/x for n in M}
-        z=1/len(M)
-        y=[k/z*100 for k in q.values()]
-        colors,fig=dbl.plot_start(bcmap[0],len(M),'Variant mix composition')
-        plt.bar(M.keys(),y,color=colors.colors)
-        plt.xticks(rotation=90)
-        plt.ylabel('% of equimolar frequency')
-        plt.margins(x=0.015)
+        y=M/M.sum()/(1/len(V))*100
         a=pre+'variant-mix-composition'
-        dbl.plot_end(fig,a,format,mppdf)
-        dbl.csv_write(a+'.csv',list(M.keys()),y,None,'Variant mix composition',None)
-        V=[V[i] for i in range(len(V)) if y[i]>=thr]
-        if len(V)<len(M):
+        J.append((plot_bars,(bcmap[0],'Variant mix composition',*others(args.top,y,V,y),'% of equimolar frequency',args.large),a))
+        J.append(('csv',(a+'.csv',V,y.tolist(),None,'Variant mix composition',None)))
+        x=y>=thr
+        if not x.all():
             print('\n  The following variants will be excluded from further analysis because their mix frequencies are below the threshold:')
-            print('  '+'\n  '.join([k for k in M if not k in V])+'\n')
-        z=sum([M[n] for n in V])
-        M={n:M[n]/z for n in V}
+            print('  '+'\n  '.join([V[i] for i in range(len(V)) if not x[i]])+'\n')
+        V=[V[i] for i in range(len(V)) if x[i]]
+        BC=BC[:,x]
+        M=M[x]
+        z=int(M.sum())
+        M=M/z
     ### Plot global read count per sample ###
-    BC={k:{n:1 for n in V} for k in S}
-    for n in bcount:
-        for q in n[:-1]:
-            if q in V:
-                x=set(k for k in n[:-1] if k!=q)
-                break
-        else:
-            continue
-        if x in S.values():
-            y=[k for k in S if S[k]==x][0]
-            BC[y][q]=n[-1]
-    del bcount
     x=[]
     y=[]
     if mix:
         x.append(mix)
         y.append(z)
     x.extend(list(S.keys()))
-    y.extend([sum(BC[k].values()) for k in BC])
-    colors,fig=dbl.plot_start(bcmap[1],len(x),'Global read count per sample')
-    plt.bar(x,y,color=colors.colors)
-    plt.xticks(rotation=90)
-    plt.ylabel('Read count')
-    plt.margins(x=0.015)
+    y.extend(BC.sum(axis=1).tolist())
     a=pre+'read-count-per-sample'
-    dbl.plot_end(fig,a,format,mppdf)
-    dbl.csv_write(a+'.csv',x,y,None,'Global read cont per sample',None)
+    J.append((plot_bars,(bcmap[1],'Global read count per sample',x,y,'Read count',args.large),a))
+    J.append(('csv',(a+'.csv',x,y,None,'Global read cont per sample',None)))
     ### Plot global variant enrichment ###
-    for n in BC:
-        for m in BC[n]:
-            z=BC[n][m]/y[x.index(n)]
-            if mix:
-                BC[n][m]=z/M[m]
-            else:
-                BC[n][m]=z*len(V)
-    colors,fig=dbl.plot_start(None,None,'Global variant enrichment')
-    x=[[np.log10(n) for n in list(BC[k].values())] for k in BC]
-    a=(list(BC.keys()),V)
+    BC=BC/np.array([y[x.index(n)] for n in S])[:,None]
+    if mix:
+        BC=BC/M
+    else:
+        BC=BC*len(V)
+    x=np.log10(BC)
+    a=(list(S.keys()),V)
+    W,y=others(args.top,BC.mean(axis=0),V,BC)
+    y=np.log10(y)
+    c=(a[0],W)
     if not xaxis:
-        x=list(zip(*x))
-    plt.imshow(x,aspect='auto',cmap=hcmap[0])
-    lim=max(max([n for m in x for n in m]),abs(min([n for m in x for n in m])))
-    plt.clim(-lim, lim)
-    plt.colorbar(shrink=0.7,pad=0.015,label='Log(Enrichment factor)')
-    plt.xticks(range(len(a[xaxis])),a[xaxis],rotation=90)
-    plt.yticks(range(len(a[not xaxis])),a[not xaxis])
+        x=x.T
+        y=y.T
     b=pre+'global_enrichment'
-    dbl.plot_end(fig,b,format,mppdf)
-    dbl.csv_write(b+'.csv',a[not xaxis],x,a[xaxis],'Global enrichment',None)
+    J.append((plot_heat,(hcmap[0],'Global variant enrichment',y,c[xaxis],c[not xaxis],'Log(Enrichment factor)',max(y.max(),abs(y.min())),args.large),b))
+    J.append(('csv',(b+'.csv',a[not xaxis],x.tolist(),a[xaxis],'Global enrichment',None)))
+    ### Scale enrichment to global titers ###
+    x=np.array([gtit.get(n,etit.get(n,np.nan)) for n in S])
+    y=~np.isnan(x)
+    BC[y]=BC[y]/np.cumsum(BC[y],axis=1)[:,-1:]*x[y,None]
+    Sx={n:i for i,n in enumerate(S)}
     ### Plot global biodistributions ###
-    a=[]
-    if gtit:
-        a.append(gtit)
-    if etit:
-        a.append(etit)
-    for n in BC:
-        for q in a:
-            if n in q:
-                x=sum(BC[n].values())
-                for m in BC[n]:
-                    BC[n][m]=BC[n][m]/x*q[n]
-                break
     for i in range(len(comb)):
         if not comb[i]:
             continue
@@ -762,17 +1227,8 @@ def analyze(args):
             a=etit
         else:
             continue
-        locs=list(range(len(titles[i][1:])))
         labels=list(comb[i].keys())
-        colors,fig=dbl.plot_start(bcmap[2],len(labels),'Global '+titles[i][0].lower()+' biodistribution')
-        z=0.8/len(labels)
-        w=z*0.95
-        for k in range(len(labels)):
-            plt.bar([n+z*k for n in locs],[a[comb[i][labels[k]][j]] for j in range(len(comb[i][labels[k]]))],width=w,label=labels[k],color=colors.colors[k])
-        plt.xticks([n+z*k/2 for n in locs],titles[i][1:])
-        plt.ylabel(unit)
-        plt.legend()
-        dbl.plot_end(fig,pre+'global_'+titles[i][0].lower()+'_biodistribution',format,mppdf)
+        J.append((plot_groups,(bcmap[2],'Global '+titles[i][0].lower()+' biodistribution',[[a[n] for n in comb[i][k]] for k in labels],labels,titles[i][1:],unit,None,None,None,args.large),pre+'global_'+titles[i][0].lower()+'_biodistribution'))
     ### Detailed biodistributions ###
     for i in range(len(comb)):
         if not comb[i]:
@@ -785,55 +1241,252 @@ def analyze(args):
             a=etit
         else:
             unit='Enrichment factor'
-        colors,fig=dbl.plot_start(None,None,titles[i][0]+' biodistribution')
-        X=[[dbl.mean([BC[n][m] for n in comb[i][k]]) for m in V] for k in comb[i]]
-        if showerr=='r':
-            yerr0=[[min([BC[n][m] for n in comb[i][k]]) for m in V] for k in comb[i]]
-            yerr1=[[max([BC[n][m] for n in comb[i][k]]) for m in V] for k in comb[i]]
-        elif showerr=='se':
-            yerr0=[[np.std([BC[n][m] for n in comb[i][k]],ddof=1)/np.sqrt(np.size([BC[n][m] for n in comb[i][k]])) for m in V] for k in comb[i]]
-        elif showerr=='sd':
-            yerr0=[[np.std([BC[n][m] for n in comb[i][k]],ddof=1) for m in V] for k in comb[i]]
-        if showind:
-            show=[[[BC[n][m] for n in comb[i][k]] for m in V] for k in comb[i]]
+        G=[BC[[Sx[n] for n in comb[i][k]]] for k in comb[i]]
+        Y=replicates(G,showerr,showind)
+        X=Y[0]
+        W,*G=others(args.top,X.mean(axis=0),V,*G)
+        if W is not V:
+            Y=replicates(G,showerr,showind)
         a=(list(comb[i].keys()),V)
+        b=(a[0],W)
         if not xaxis:
-            X=list(zip(*X))
-        plt.imshow(X,aspect='auto',cmap=hcmap[1])
-        plt.colorbar(shrink=0.7,pad=0.015,label=unit)
-        plt.xticks(range(len(a[xaxis])),a[xaxis],rotation=90)
-        plt.yticks(range(len(a[not xaxis])),a[not xaxis])
-        dbl.plot_end(fig,pre+titles[i][0],format,mppdf)
-        locs=list(range(len(a[not xaxis])))
-        labels=a[xaxis]
-        colors,fig=dbl.plot_start(bcmap[3],len(a[xaxis]),titles[i][0]+' biodistribution')
-        z=0.8/len(labels)
-        w=z*0.95 
+            X=X.T
+            Y=[None if k is None else k.T if k.ndim==2 else k.transpose(1,0,2) for k in Y]
+        Y,yerr0,yerr1,show=Y
+        J.append((plot_heat,(hcmap[1],titles[i][0]+' biodistribution',Y,b[xaxis],b[not xaxis],unit,None,args.large),pre+titles[i][0]))
+        e=None
+        if showerr=='r':
+            e=[[Y[:,j]-yerr0[:,j],yerr1[:,j]-Y[:,j]] for j in range(len(b[xaxis]))]
+        elif showerr:
+            e=[[yerr0[:,j],yerr0[:,j]] for j in range(len(b[xaxis]))]
+        y=None
+        if showind:
+            y=[show[:,j] for j in range(len(b[xaxis]))]
+        J.append((plot_groups,(bcmap[3],titles[i][0]+' biodistribution',[Y[:,j] for j in range(len(b[xaxis]))],b[xaxis],b[not xaxis],unit,e,y,showind,args.large),pre+titles[i][0]+'_biodistribution'))
+        J.append(('csv',(pre+titles[i][0]+'_biodistribution.csv',a[not xaxis],X.tolist(),a[xaxis],titles[i][0]+' biodistribution',None)))
+    f.close()
+    ### Save figures and csv files ###
+    if not args.plots:
+        J=[k for k in J if k[0]=='csv']
+    figures(J,format,fname,args.threads,args.cache,args.cache_size)
+    if fname:
+        print('\n  All figures were saved into single multipage file: '+fname+'\n')
+
+def plot_bars(cmap,title,x,y,ylabel,large=0):
+    from matplotlib import pyplot as plt
+    colors,fig=dbl.plot_start(cmap,len(x),title)
+    if large and len(x)>large:
+        bars(range(len(x)),y,0.8,colors.colors)
+        k=-(-len(x)//50)
+        plt.xticks(range(0,len(x),k),x[::k],rotation=90)
+    else:
+        plt.bar(x,y,color=colors.colors)
+        plt.xticks(rotation=90)
+    plt.ylabel(ylabel)
+    plt.margins(x=0.015)
+    return fig
+
+def plot_heat(cmap,title,X,xl,yl,label,lim=None,large=0):
+    from matplotlib import pyplot as plt
+    colors,fig=dbl.plot_start(None,None,title)
+    if large and max(len(xl),len(yl))>large:
+        plt.imshow(X,aspect='auto',cmap=cmap,interpolation='nearest')
+    else:
+        plt.imshow(X,aspect='auto',cmap=cmap)
+    if lim is not None:
+        plt.clim(-lim, lim)
+    plt.colorbar(shrink=0.7,pad=0.015,label=label)
+    x=y=1
+    if large and len(xl)>large:
+        x=-(-len(xl)//50)
+    if large and len(yl)>large:
+        y=-(-len(yl)//50)
+    plt.xticks(range(0,len(xl),x),xl[::x],rotation=90)
+    plt.yticks(range(0,len(yl),y),yl[::y])
+    return fig
+
+def plot_groups(cmap,title,Y,labels,ticks,unit,err=None,show=None,marker=None,large=0):
+    import numpy as np
+    from matplotlib import pyplot as plt
+    locs=list(range(len(ticks)))
+    colors,fig=dbl.plot_start(cmap,len(labels),title)
+    z=0.8/len(labels)
+    w=z*0.95
+    h=None
+    if large and len(labels)*len(locs)>large:
+        x=np.array([[n+z*j for n in locs] for j in range(len(labels))]).ravel()
+        y=np.array(Y,dtype=float).ravel()
+        bars(x,y,w,np.repeat(np.array(colors.colors),len(locs),axis=0))
+        if err:
+            e=np.array(err,dtype=float)
+            plt.errorbar(x,y,yerr=[e[:,0].ravel(),e[:,1].ravel()],fmt='none',ecolor='black',elinewidth=0.5,capsize=0,rasterized=True)
+        if show:
+            e=np.array(show,dtype=float)
+            plt.plot(np.repeat(x,e.shape[-1]),e.ravel(),marker,markersize=2,rasterized=True)
+        j=len(labels)-1
+        from matplotlib.patches import Patch
+        h=[Patch(color=colors.colors[k],label=labels[k]) for k in range(len(labels))]
+    else:
         for j in range(len(labels)):
             x=[n+z*j for n in locs]
-            h=[X[k][j] for k in range(len(a[not xaxis]))]
-            plt.bar(x,[X[k][j] for k in range(len(a[not xaxis]))],width=w,label=labels[j],color=colors.colors[j])
-            if showerr:
-                if showerr=='r':
-                    e0=[X[k][j]-yerr0[k][j] for k in range(len(a[not xaxis]))]
-                    e1=[yerr1[k][j]-X[k][j] for k in range(len(a[not xaxis]))]
-                else:
-                    e0=[yerr0[k][j] for k in range(len(a[not xaxis]))]
-                    e1=e0
-                plt.errorbar(x,h,yerr=[e0,e1],fmt='none',ecolor='black',capsize=2)
-            if showind:
-                y=[show[k][j] for k in range(len(a[not xaxis]))]
-                for x1, y1 in zip(x, y):
-                    plt.plot([x1] * len(y1), y1,showind)
-        plt.xticks([n+z*j/2 for n in locs],a[not xaxis])
-        plt.ylabel(unit)
-        plt.legend()
-        dbl.plot_end(fig,pre+titles[i][0]+'_biodistribution',format,mppdf)
-        dbl.csv_write(pre+titles[i][0]+'_biodistribution.csv',a[not xaxis],X,a[xaxis],titles[i][0]+' biodistribution',None)
-    if not format:
+            plt.bar(x,Y[j],width=w,label=labels[j],color=colors.colors[j])
+            if err:
+                plt.errorbar(x,Y[j],yerr=err[j],fmt='none',ecolor='black',capsize=2)
+            if show:
+                for x1, y1 in zip(x, show[j]):
+                    plt.plot([x1] * len(y1), y1,marker)
+    k=1
+    if large and len(locs)>large:
+        k=-(-len(locs)//50)
+    plt.xticks([n+z*j/2 for n in locs][::k],ticks[::k])
+    plt.ylabel(unit)
+    if not large or len(labels)<=large:
+        plt.legend(handles=h)
+    return fig
+
+def bars(x,y,w,c):
+    import numpy as np
+    from matplotlib import pyplot as plt
+    x=np.asarray(x,dtype=float)
+    y=np.asarray(y,dtype=float)
+    v=np.zeros((len(x),4,2))
+    v[:,:2,0]=(x-w/2)[:,None]
+    v[:,2:,0]=(x+w/2)[:,None]
+    v[:,1:3,1]=y[:,None]
+    ax=plt.gca()
+    from matplotlib.collections import PolyCollection
+    p=PolyCollection(v,facecolors=c,edgecolors='none',rasterized=True)
+    p.sticky_edges.y.append(0)
+    ax.add_collection(p)
+    ax.autoscale_view()
+
+def others(n,s,V,*A):
+    import numpy as np
+    if not n or len(V)<=n+1:
+        return (V,)+A
+    i=np.sort(np.argsort(-np.asarray(s),kind='stable')[:n])
+    r=np.ones(len(V),dtype=bool)
+    r[i]=False
+    return ([V[k] for k in i]+['others'],)+tuple([np.concatenate([a[...,i],a[...,r].mean(axis=-1,keepdims=True)],axis=-1) for a in A])
+
+def replicates(G,showerr,showind):
+    import numpy as np
+    X=np.array([np.cumsum(k,axis=0)[-1]/len(k) for k in G])
+    yerr0=yerr1=show=None
+    if showerr=='r':
+        yerr0=np.array([k.min(axis=0) for k in G])
+        yerr1=np.array([k.max(axis=0) for k in G])
+    elif showerr=='se':
+        yerr0=np.array([np.std(np.ascontiguousarray(k.T),axis=1,ddof=1)/np.sqrt(len(k)) for k in G])
+    elif showerr=='sd':
+        yerr0=np.array([np.std(np.ascontiguousarray(k.T),axis=1,ddof=1) for k in G])
+    if showind:
+        show=np.array([k.T for k in G])
+    return X,yerr0,yerr1,show
+
+def plot_render(job,format,mppdf):
+    f,x,name=job
+    dbl.plot_end(f(*x),name,format,mppdf)
+
+def plot_init():
+    from matplotlib import pyplot as plt
+    plt.switch_backend('Agg')
+    logging.getLogger('matplotlib.font_manager').setLevel(logging.ERROR)
+
+def plot_job(x):
+    job,format,p=x
+    with contextlib.redirect_stdout(io.StringIO()) as f:
+        if p:
+            from matplotlib.backends.backend_pdf import PdfPages
+            with PdfPages(p) as m:
+                plot_render(job,None,m)
+        else:
+            plot_render(job,format,None)
+    return f.getvalue()
+
+def job_key(job,format):
+    x=(__version__,format)+tuple([k.__name__ if callable(k) else k for k in job])
+    return hashlib.sha1(pickle.dumps(x,4)).hexdigest()
+
+def figures(J,format,fname,threads=1,cache='',size=1000):
+    F=[i for i in range(len(J)) if J[i][0]!='csv']
+    try:
+        import pypdf
+    except ImportError:
+        pypdf=None
+    K={}
+    C=set()
+    doc=None
+    if cache:
+        os.makedirs(cache,exist_ok=True)
+        for i in range(len(J)):
+            K[i]=os.path.join(cache,job_key(J[i],format)+'.'+('csv' if J[i][0]=='csv' else format or 'pdf'))
+            if os.path.isfile(K[i]):
+                C.add(i)
+                os.utime(K[i])
+        if fname and not pypdf:
+            doc=os.path.join(cache,digest(*[K[i] for i in F])+'.pdf')
+            C-=set(F)
+            if os.path.isfile(doc):
+                C|=set(F)
+                os.utime(doc)
+    T=[i for i in F if i not in C]
+    mppdf=None
+    d=None
+    if fname and T:
+        if pypdf and (cache or (threads>1 and len(T)>1)):
+            d=cache or tempfile.mkdtemp()
+            if not cache:
+                K={i:os.path.join(d,str(i)+'.pdf') for i in F}
+        else:
+            from matplotlib.backends.backend_pdf import PdfPages
+            mppdf=PdfPages(fname)
+    pool=None
+    R=None
+    if threads>1 and len(T)>1 and (format or d):
+        pool=mp.Pool(min(threads,len(T)),initializer=plot_init)
+        R=pool.imap(plot_job,[(J[i],format,d and K[i]) for i in T])
+    for i,k in enumerate(J):
+        if k[0]=='csv':
+            if i in C:
+                shutil.copyfile(K[i],k[1][0])
+                if k[1][4]:
+                    dbl.pr2(k[1][5],'\n  '+k[1][4]+' saved into file: '+k[1][0])
+            else:
+                dbl.csv_write(*k[1])
+                if cache:
+                    shutil.copyfile(k[1][0],K[i])
+        elif i in C:
+            if format:
+                shutil.copyfile(K[i],k[2]+'.'+format)
+                print('  Figure was saved into file: '+k[2]+'.'+format+'\n')
+        elif R:
+            print(next(R),end='')
+        elif d:
+            print(plot_job((k,None,K[i])),end='')
+        else:
+            plot_render(k,format,mppdf)
+        if cache and format and i in T:
+            shutil.copyfile(k[2]+'.'+format,K[i])
+    if pool:
+        pool.close()
+        pool.join()
+    if d or (fname and pypdf and cache):
+        w=pypdf.PdfWriter()
+        for i in F:
+            w.append(K[i])
+        w.write(fname)
+        if d and not cache:
+            shutil.rmtree(d)
+    elif mppdf:
         mppdf.close()
-        print('\n  All figures were saved into single multipage file: '+fname+'\n')
-    f.close()
+        if doc:
+            shutil.copyfile(fname,doc)
+    elif doc:
+        shutil.copyfile(doc,fname)
+    if cache:
+        cache_prune(cache,size)
+        print('\n  '+str(len(C))+' of '+str(len(J))+' figures and csv files were unchanged and copied from cache directory '+cache)
 
 def anaconf(fname,args):
     x=glob('*_count_report.txt')
@@ -841,11 +1494,20 @@ def anaconf(fname,args):
         print('\n  Count report file not found! It must be present in the working directory!\n')
         sys.exit()
     report=max(x,key=os.path.getctime)
-    f=open(report,'r')
-    tlen=0
-    defn=[]
-    rfp=[]
-    cfile=''
+    x=load_bin(report[:-11]+'.bsq')
+    if x:
+        x=x[1]
+        f=[]
+        tlen=x['tlen']
+        defn=[[tuple(k[0]),k[1]] for k in x['defn']]
+        rfp=x['rfp']
+        cfile=x['csv']
+    else:
+        f=open(report,'r')
+        tlen=0
+        defn=[]
+        rfp=[]
+        cfile=''
     a=b=c=False
     for l in f:
         l=l.strip()
@@ -887,7 +1549,8 @@ def anaconf(fname,args):
                 d[0]+=(int(ln[i]),)
             if not d in defn:
                 defn.append(d)
-    f.close()
+    if not x:
+        f.close()
     if not defn:
         print('\n  No variant or sample definition found!\n')
         sys.exit()
@@ -996,36 +1659,709 @@ def countconf(fname,args):
     content+='# PROBE LENGTH\nInstructions: Minimum length in nt of sequences used as probes to locate barcodes (integer between 1 and 50.\n\n5\n\n'
     dbl.conf_end(fname,content,z)
 
-def find_bc(l,templ,bcr,cl,ctempl,cbcr):
+def read_chunks(f,step,t,reads=None,size=10000,prof=None):
+    print('  '+t,end='')
+    n=0
+    c=0
+    y=list(reads or [])
+    while True:
+        z=time.perf_counter()
+        while len(y)<size:
+            l,f,c,_=dbl.getread(f,step,c)
+            if not l:
+                break
+            y.append(l)
+        if prof is not None:
+            tick(prof,'Reading',time.perf_counter()-z,len(y))
+        if y:
+            n+=len(y)
+            yield y
+            print('\r  '+t+f' {n:,} reads',end='')
+        if len(y)<size:
+            break
+        y=[]
+
+def mmap_open(fname):
+    if fname not in _mm:
+        f=open(fname,'rb')
+        _mm[fname]=(f,mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ))
+    return _mm[fname][1]
+
+def mmap_close(fname):
+    if fname in _mm:
+        f,m=_mm.pop(fname)
+        m.close()
+        f.close()
+
+def record_start(m,pos,step):
+    if pos<=0:
+        return 0
+    x=b'\n>'
+    if step==4:
+        x=b'\n@'
+    while True:
+        i=m.find(x,pos-1)
+        if i==-1:
+            return len(m)
+        i+=1
+        if step!=4:
+            return i
+        j=m.find(b'\n',m.find(b'\n',i)+1)
+        if j==-1 or m[j+1:j+2]==b'+':
+            return i
+        pos=i+1
+
+def mmap_chunks(fname,step,t,start=0,size=10000,fp=None,end=None):
+    m=mmap_open(fname)
+    n=len(m)
+    if end is not None:
+        n=end
+    x=m[:65536]
+    if step:
+        y=x.count(b'\n')//step
+    else:
+        y=x.count(b'>')
+    y=max(1,int(size*len(x)/max(y,1)))
+    print('  '+t+'     0.0%',end='')
+    a=record_start(m,start,step)
+    while a<n:
+        b=min(n,record_start(m,a+y,step))
+        if fp is not None:
+            fp.append(b)
+        yield (fname,a,b,step)
+        k=str(round(b/n*100,1))
+        print('\r  '+t+' '*(8-len(k))+k+'%',end='')
+        a=b
+
+def mmap_reads(fname,a,b,step):
+    with memoryview(mmap_open(fname))[a:b] as x:
+        return parse_reads(x,step)
+
+def parse_reads(x,step):
+    x=str(x,'latin-1')
+    if '\r' in x:
+        x=x.replace('\r','')
+    if step:
+        x=x.split('\n')[1::step]
+    else:
+        x=[k.partition('\n')[2].replace('\n','') for k in x.split('\n>')]
+    return [k.lower() for k in x if k]
+
+def gz_blocks(f,threads=2):
+    x=f.read(18)
+    f.seek(0)
+    if len(x)==18 and x[:4]==b'\x1f\x8b\x08\x04' and x[12:14]==b'BC':
+        with ThreadPoolExecutor(threads) as pool:
+            while True:
+                y=[]
+                for i in range(16*threads):
+                    x=f.read(18)
+                    if len(x)<18:
+                        break
+                    y.append(x+f.read(int.from_bytes(x[16:18],'little')-17))
+                if not y:
+                    break
+                for x in pool.map(inflate,y):
+                    yield x
+    else:
+        d=zlib.decompressobj(31)
+        for x in iter(lambda:f.read(1<<20),b''):
+            while x:
+                yield d.decompress(x)
+                if not d.eof:
+                    break
+                x=d.unused_data
+                d=zlib.decompressobj(31)
+        yield d.flush()
+
+def inflate(x):
+    return zlib.decompress(x[12+int.from_bytes(x[10:12],'little'):-8],-15)
+
+def gz_chunks(fname,step,t,start=0,size=10000,fp=None,prof=None,threads=2,depth=4):
+    f=open(fname,'rb')
+    fs=os.fstat(f.fileno()).st_size
+    q=queue.Queue(depth)
+    def produce():
+        try:
+            b=[]
+            n=0
+            m=-start
+            y=0
+            for x in gz_blocks(f,threads):
+                if m<0:
+                    m+=len(x)
+                    if m<=0:
+                        continue
+                    x=x[-m:]
+                    m=0
+                b.append(x)
+                n+=len(x)
+                if not y and n>=65536:
+                    b=[b''.join(b)]
+                    if step:
+                        y=b[0][:65536].count(b'\n')//step
+                    else:
+                        y=b[0][:65536].count(b'>')
+                    y=max(1,int(size*65536/max(y,1)))
+                if not y or n<y:
+                    continue
+                b=b''.join(b)
+                k=record_start(b,y,step)
+                b=[b]
+                if k<n:
+                    m+=k
+                    q.put((parse_reads(memoryview(b[0])[:k],step),start+m,f.tell()))
+                    b=[b[0][k:]]
+                    n-=k
+            if n:
+                q.put((parse_reads(b''.join(b),step),start+m+n,fs))
+            q.put(None)
+        except Exception as e:
+            q.put(e)
+    threading.Thread(target=produce,daemon=True).start()
+    print('  '+t+'     0.0%',end='')
+    while True:
+        z=time.perf_counter()
+        x=q.get()
+        if isinstance(x,Exception):
+            raise x
+        if x is None:
+            break
+        y,a,b=x
+        if prof is not None:
+            tick(prof,'Reading',time.perf_counter()-z,len(y))
+        if fp is not None:
+            fp.append(a)
+        yield y
+        k=str(round(min(b,fs)/max(fs,1)*100,1))
+        print('\r  '+t+' '*(8-len(k))+k+'%',end='')
+    f.close()
+
+def is_stream(fname):
+    return fname=='-' or (os.path.exists(fname) and stat.S_ISFIFO(os.stat(fname).st_mode))
+
+class Stream:
+    __slots__='f','lines'
+    def __init__(self,f,lines):
+        self.f=f
+        self.lines=deque(lines)
+    def readline(self):
+        if self.lines:
+            return self.lines.popleft()
+        return self.f.readline()
+    def close(self):
+        if self.f is not sys.stdin:
+            self.f.close()
+
+def stream_open(fname):
+    f=sys.stdin
+    if fname!='-':
+        f=open(fname,'r')
+    x=[f.readline()]
+    y=4
+    if not x[0] or x[0][0] not in ('>','@'):
+        print('\n\n  '+fname+' does not look like a fastq or fasta file.\n')
+        sys.exit()
+    if x[0][0]=='>':
+        x+=[f.readline(),f.readline()]
+        y=0
+        if x[2][:1]=='>':
+            y=2
+    return Stream(f,x),y
+
+def digest(*x):
+    return hashlib.sha1(repr(x).encode()).hexdigest()
+
+def data_save(fname,x,A={}):
+    h={'format':script,'byteorder':sys.byteorder,'arrays':[[k,A[k].typecode,len(A[k])] for k in A],'data':to_json(x)}
+    with open(fname+'.tmp','wb') as f:
+        f.write(json.dumps(h).encode()+b'\n')
+        for k in A:
+            A[k].tofile(f)
+    os.replace(fname+'.tmp',fname)
+
+def data_load(fname):
+    with open(fname,'rb') as f:
+        h=json.loads(f.readline())
+        if type(h) is not dict or h.get('format')!=script:
+            raise ValueError('not a '+script+' data file: '+fname)
+        A={}
+        for k,t,n in h['arrays']:
+            A[k]=array(t)
+            A[k].fromfile(f,n)
+            if h['byteorder']!=sys.byteorder:
+                A[k].byteswap()
+    return from_json(h['data']),A
+
+def to_json(x):
+    if isinstance(x,tuple):
+        return {'t':[to_json(k) for k in x]}
+    if type(x) is dict:
+        return {'d':[[to_json(k),to_json(v)] for k,v in x.items()]}
+    if type(x) is list:
+        return [to_json(k) for k in x]
+    return x
+
+def from_json(x):
+    if type(x) is list:
+        return [from_json(k) for k in x]
+    if type(x) is dict:
+        if 't' in x:
+            return tuple([from_json(k) for k in x['t']])
+        return {from_json(k):from_json(v) for k,v in x['d']}
+    return x
+
+def save_checkpoint(fname,state):
+    with open(fname+'.tmp','wb') as f:
+        pickle.dump(state,f,pickle.HIGHEST_PROTOCOL)
+    os.replace(fname+'.tmp',fname)
+
+def file_id(fname):
+    if is_stream(fname):
+        return ()
+    x=os.stat(fname)
+    return (x.st_size,x.st_mtime_ns)
+
+def file_hash(fname,cache):
+    k=(os.path.abspath(fname),)+file_id(fname)
+    y=os.path.join(cache,'hashes.pkl')
+    z={}
+    if os.path.isfile(y):
+        with open(y,'rb') as f:
+            z=pickle.load(f)
+    if k not in z:
+        h=hashlib.sha1()
+        with open(fname,'rb') as f:
+            for n in iter(lambda:f.read(1<<20),b''):
+                h.update(n)
+        z={n:z[n] for n in z if n[0]!=k[0] and os.path.isfile(n[0])}
+        z[k]=h.hexdigest()
+        while len(z)>10000:
+            del z[next(iter(z))]
+        os.makedirs(cache,exist_ok=True)
+        save_checkpoint(y,z)
+    return z[k]
+
+def cache_load(cache,key):
+    x=os.path.join(cache,key+'.pkl')
+    if not os.path.isfile(x):
+        return None
+    os.utime(x)
+    with open(x,'rb') as f:
+        return pickle.load(f)
+
+def cache_save(cache,key,data,size):
+    os.makedirs(cache,exist_ok=True)
+    save_checkpoint(os.path.join(cache,key+'.pkl'),data)
+    cache_prune(cache,size)
+
+def cache_prune(cache,size):
+    x=sorted([k for k in glob(os.path.join(cache,'*.*')) if os.path.basename(k)!='hashes.pkl'],key=os.path.getmtime)
+    y=sum([os.path.getsize(k) for k in x])
+    while len(x)>1 and y>size*1048576:
+        y-=os.path.getsize(x[0])
+        os.remove(x.pop(0))
+
+def load_checkpoint(fname,dg):
+    if not dbl.check_file(fname,False):
+        print('  Checkpoint file '+fname+' not found! All reads will be processed.\n')
+        return None
+    with open(fname,'rb') as f:
+        state=pickle.load(f)
+    if state['digest']!=dg:
+        print('\n  Checkpoint file '+fname+' was created with a different configuration or different read files! Delete it or restore the configuration before resuming.\n')
+        sys.exit()
+    return state
+
+def rfile_table(r,rfiles):
+    dbl.pr2(r,'  Read file prefix         Read file                     Number of reads    Read orientation')
+    for n in rfiles:
+        x=''
+        if n[2] is not None:
+            x=f'{n[2]:,}'
+        dbl.pr2(r,'  '+n[0].ljust(25)+n[1].ljust(30)+x.rjust(15)+n[3].center(24))
+    dbl.pr2(r,'')
+
+def count_reads(reads,ori,settings,batch=False,prof=False,dedup=0,memo=0):
+    templ,R,sig,BC,BCI,sh=settings
+    pc=time.perf_counter
+    Q=None
+    if prof:
+        Q={}
+    T=Counts()
+    ids=T.ids
+    N=T.n
+    ec=[0,0,0,0,0,0,0,0,0,0,0,0,0]
+    C=0
+    compr=True in [r.compr for r in R]
+    L=None
+    if dedup:
+        L=lru('reads',dedup,ori,settings)
+        W={}
+    M=None
+    if memo:
+        M={r.i:(lru('window'+str(r.i),memo//(2*len(R)),settings),lru('cwindow'+str(r.i),memo//(2*len(R)),settings)) for r in R}
+        m=[(k.hits,k.n) for k in sum(M.values(),())]
+    x=reads
+    if batch:
+        t=pc()
+        x=batch_decode(reads,ori,settings)
+        if prof:
+            tick(Q,'Batch decoding',pc()-t,sum([k[2] for k in x if type(k) is tuple]))
+    for l in x:
+        K=None
+        if type(l) is tuple:
+            X,q,k=l
+            p=0
+            ec[5+q]+=k
+        else:
+            if prof:
+                t=pc()
+            k=1
+            if L is not None:
+                ec[8]+=1
+                v=L.get(l)
+                if v is not None:
+                    ec[7]+=1
+                    if prof:
+                        tick(Q,'Read cache hits',pc()-t)
+                    if not v:
+                        continue
+                    K,w=v
+                    for i,n in w:
+                        ec[i]+=n
+            if K is None:
+                X1=X2=None
+                p1=p2=0
+                cl=''
+                if compr:
+                    cl=dbl.compress(l)
+                s=ori
+                if ori=='Both' and sig:
+                    s=strand(l,sig)
+                if s!='-':
+                    X1,p1,ec1=find_bc(l,cl,R,M)
+                if s!='+' or (ori=='Both' and not (X1 and not p1)):
+                    X2,p2,ec2=find_bc(l[::-1].translate(RC),cl,R,M)
+                if s=='-' and ori=='Both' and not (X2 and not p2):
+                    X1,p1,ec1=find_bc(l,cl,R,M)
+                if X1 and (not X2 or (X2 and p2>p1)):
+                    X=X1
+                    EC=ec1
+                    p=p1
+                    q=5
+                elif X2 and (not X1 or (X1 and p1>p2)):
+                    X=X2
+                    EC=ec2
+                    p=p2
+                    q=6
+                else:
+                    if L is not None:
+                        L.put(l,())
+                    if prof:
+                        tick(Q,'Barcodes not found',pc()-t)
+                    continue
+                ec[q]+=1
+                if prof:
+                    w='Exact match'
+                    if EC[1] or EC[2]:
+                        w='Compressed mode'
+                    elif EC[0]:
+                        w='Alternate position'
+                    tick(Q,w,pc()-t)
+                    if X1 is not None and X2 is not None:
+                        tick(Q,'Both strands searched',0)
+                for i in range(len(EC)):
+                    ec[i]+=EC[i]
+                X=[pack(X[r.i]) for r in R]
+        if prof:
+            t=pc()
+        C+=k
+        if K is None:
+            K=0
+            s=0
+            z=False
+            if prof:
+                t2=pc()
+            for j in range(len(X)):
+                c=X[j]
+                if c not in BC[j] and BCI[j]:
+                    n=BCI[j].get(c)
+                    if n:
+                        c=X[j]=n
+                        s+=1
+                if type(c) is int:
+                    K|=c<<sh[j]
+                else:
+                    z=True
+            if prof:
+                tick(Q,'Substitution correction',pc()-t2,k)
+            if s:
+                ec[3]+=s*k
+            if p or s:
+                ec[4]+=k
+            if z:
+                K=tuple(X)
+            if L is not None and type(l) is not tuple:
+                w=tuple([(i,EC[i]) for i in range(len(EC)) if EC[i]]+[(3,s)]*bool(s)+[(4,1)]*bool(p or s)+[(q,1)])
+                L.put(l,(K,W.setdefault(w,w)))
+        i=ids.get(K)
+        if i is None:
+            ids[K]=len(N)
+            N.append(k)
+        else:
+            N[i]+=k
+        if prof:
+            tick(Q,'Barcode identification and correction',pc()-t,k)
+    if L is not None:
+        ec[9]=L.peak
+    if M is not None:
+        x=sum(M.values(),())
+        ec[10]=sum([k.hits for k in x])-sum([k[0] for k in m])
+        ec[11]=sum([k.n for k in x])-sum([k[1] for k in m])
+        ec[12]=sum([k.peak for k in x])
+    return T,ec,C,len(reads),Q
+
+def profile_save(fname,P,t,n,info):
+    x={'version':__version__,'time':t,'reads':n,'reads per second':n/max(t,1e-9),**info,'stages':{}}
+    for k in P:
+        if P[k][1]:
+            x['stages'][k]={'count':P[k][0],'time':P[k][1],'mean time (us)':P[k][1]/max(P[k][0],1)*1e6}
+        else:
+            x['counters'][k]=P[k][0]
+    with open(fname,'w') as f:
+        json.dump(x,f,indent=2)
+    print('  Profile was saved into file: '+fname+'\n')
+
+def tick(P,k,t,n=1):
+    x=P.setdefault(k,[0,0.0])
+    x[0]+=n
+    x[1]+=t
+
+def batch_decode(reads,ori,settings):
+    import numpy as np
+    templ,R=settings[:2]
+    n=len(reads)
+    w=max([r.c for r in R])
+    L=np.fromiter(map(len,reads),dtype=np.int64,count=n)
+    T=np.frombuffer(templ[:w].encode(),dtype=np.uint8)
+    F=sorted(set([j for r in R for j in list(range(r.a,r.i))+list(range(r.b,r.c))]))
+    B=[list(range(r.i,r.b)) for r in R]
+    W=[np.uint64(4)**np.arange(len(k)-1,-1,-1,dtype=np.uint64) for k in B]
+    v=max([len(k) for k in B])<32
+    nt2=np.frombuffer(NT2,dtype=np.uint8)
+    y=[None]*n
+    left=np.nonzero(L>=w)[0]
+    for q in (0,1):
+        if (q==0 and ori=='-') or (q==1 and ori=='+') or not len(left):
+            continue
+        if q==0:
+            A=''.join([reads[k][:w] for k in left])
+        else:
+            A=''.join([reads[k][-w:][::-1] for k in left])
+        A=A.encode()
+        if q==1:
+            A=A.translate(COMP)
+        A=np.frombuffer(A,dtype=np.uint8).reshape(len(left),w)
+        hit=(A[:,F]==T[F]).all(axis=1)
+        if v:
+            Z=[nt2[A[:,k]] for k in B]
+            for k in Z:
+                hit&=(k<4).all(axis=1)
+            Z=np.stack([(k[hit].astype(np.uint64)*w).sum(axis=1,dtype=np.uint64)+np.uint64(4**len(w)) for k,w in zip(Z,W)],axis=1)
+        else:
+            Z=np.ascontiguousarray(A[hit][:,[j for k in B for j in k]])
+        rows=left[hit]
+        if len(rows):
+            _,first,m=np.unique(Z.view(np.dtype((np.void,Z.shape[1]*Z.itemsize))).ravel(),return_index=True,return_counts=True)
+            for j in range(len(first)):
+                if v:
+                    X=[int(k) for k in Z[first[j]]]
+                else:
+                    x=Z[first[j]].tobytes().decode()
+                    X=[]
+                    a=0
+                    for k in B:
+                        X.append(pack(x[a:a+len(k)]))
+                        a+=len(k)
+                y[rows[first[j]]]=(X,q,int(m[j]))
+        left=left[~hit]
+    for k in np.nonzero(L<w)[0].tolist()+left.tolist():
+        y[k]=reads[k]
+    return [k for k in y if k is not None]
+
+def map_counts(T,pre,pos,sh,BC,dr,DEF):
+    counts=defaultdict(int)
+    for K,m in T.items():
+        if type(K) is int:
+            X={pos[j]:(K>>sh[j])&((1<<(sh[j+1]-sh[j]))-1) for j in range(len(pos))}
+        else:
+            X=dict(zip(pos,K))
+        Y=pre
+        for n in dr:
+            x=tuple([X[k] for k in n])
+            if Y:
+                Y+=','
+            if x in DEF[n]:
+                Y+=DEF[n][x]
+            else:
+                Y+=','.join([BC[pos.index(k)].get(X[k]) or unpack(X[k]) for k in n])
+        counts[Y]+=m
+    return counts.items()
+
+class Counts:
+    __slots__=('ids','n')
+    def __init__(self):
+        self.ids={}
+        self.n=array('q')
+    def add(self,k,m=1):
+        i=self.ids.get(k)
+        if i is None:
+            self.ids[k]=len(self.n)
+            self.n.append(m)
+        else:
+            self.n[i]+=m
+    def merge(self,other):
+        for k,i in other.ids.items():
+            self.add(k,other.n[i])
+    def items(self):
+        for k,i in self.ids.items():
+            yield k,self.n[i]
+    def __len__(self):
+        return len(self.n)
+
+class LRU:
+    __slots__=('d','size','mem','peak','tag','e','hits','n')
+    def __init__(self,size,tag=(),e=200):
+        self.d=OrderedDict()
+        self.size=size
+        self.mem=0
+        self.peak=0
+        self.tag=tag
+        self.e=e
+        self.hits=0
+        self.n=0
+    def get(self,k):
+        self.n+=1
+        v=self.d.get(k)
+        if v is not None:
+            self.d.move_to_end(k)
+            self.hits+=1
+        return v
+    def put(self,k,v):
+        self.d[k]=v
+        self.mem+=sys.getsizeof(k)+self.e
+        while self.mem>self.size and self.d:
+            k,v=self.d.popitem(last=False)
+            self.mem-=sys.getsizeof(k)+self.e
+        self.peak=max(self.peak,self.mem)
+    def __len__(self):
+        return len(self.d)
+
+def lru(name,size,*tag):
+    x=_lru.get(name)
+    if x is None or x.size!=size or len(x.tag)!=len(tag) or True in [a is not b and a!=b for a,b in zip(x.tag,tag)]:
+        x=_lru[name]=LRU(size,tag)
+    return x
+
+def add_ec(a,b):
+    for i in range(len(a)):
+        if i in (9,12):
+            a[i]=max(a[i],b[i])
+        else:
+            a[i]+=b[i]
+
+def pack(seq):
+    try:
+        return int('1'+seq.translate(NT4),4)
+    except ValueError:
+        return seq
+
+def unpack(x):
+    if type(x) is str:
+        return x
+    y=''
+    while x>1:
+        y='acgt'[x&3]+y
+        x>>=2
+    return y
+
+def init_worker(settings):
+    global _settings
+    _settings=settings
+
+def worker_count(reads,ori,batch,prof,dedup,memo):
+    return range_count(reads,ori,_settings,batch,prof,dedup,memo)
+
+def range_count(reads,ori,settings,batch,prof,dedup=0,memo=0):
+    if type(reads) is not tuple:
+        return count_reads(reads,ori,settings,batch,prof,dedup,memo)
+    t=time.perf_counter()
+    reads=mmap_reads(*reads)
+    t=time.perf_counter()-t
+    x=count_reads(reads,ori,settings,batch,prof,dedup,memo)
+    if prof:
+        tick(x[4],'Reading',t,len(reads))
+    return x
+
+def pool_map(pool,chunks,ori,batch,prof,depth,dedup=0,memo=0):
+    pending=deque()
+    for x in chunks:
+        pending.append(pool.apply_async(worker_count,(x,ori,batch,prof,dedup,memo)))
+        if len(pending)>=depth:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+def strand_signature(templ,k=12):
+    x=[n for n in templ.split('n') if len(n)>=8]
+    if not x:
+        return None
+    y=(x[0][:k],x[-1][-k:])
+    y+=(dbl.revcomp(y[0]),dbl.revcomp(y[1]))
+    z=dbl.revcomp(templ)
+    if y[0] in z or y[1] in z or y[2] in templ or y[3] in templ:
+        return None
+    return y
+
+def strand(l,sig):
+    a=sig[0] in l or sig[1] in l
+    b=sig[2] in l or sig[3] in l
+    if a and not b:
+        return '+'
+    if b and not a:
+        return '-'
+    return 'Both'
+
+def find_bc(l,cl,R,M=None):
     X={}
     p=0
     ec=[0,0,0]
-    for i in bcr:
-        a=bcr[i][-3]
-        b=bcr[i][-2]
-        c=bcr[i][-1]
-        if l[a:i]==templ[a:i] and l[b:min(c,len(l))]==templ[b:c]:
-            X[i]=l[i:b]
+    for r in R:
+        if l[r.a:r.i]==r.left and l[r.b:r.c]==r.right:
+            X[r.i]=l[r.i:r.b]
             continue
-        x=fb(l,templ,i,bcr)
+        if M is None:
+            x=fb(l,r.P)
+        else:
+            x=memo_fb(l,r.W,M[r.i][0])
         if x:
-            X[i]=x
+            X[r.i]=x
             p+=1
             ec[0]+=1
             continue
-        if bcr[i][2]:
-            j=list(cbcr.keys())[list(bcr.keys()).index(i)]
-            a=cbcr[j][-3]
-            b=cbcr[j][-2]
-            c=cbcr[j][-1]
-            if cl[a:j]==ctempl[a:j] and cl[b:min(c,len(cl))]==ctempl[b:c]:
-                X[i]=cl[j:b]
+        if r.compr:
+            if cl[r.ca:r.ci]==r.cleft and cl[r.cb:r.cc]==r.cright:
+                X[r.i]=cl[r.ci:r.cb]
                 p+=1
                 ec[1]+=1
                 continue
-            x=fb(cl,ctempl,j,cbcr)
+            if M is None:
+                x=fb(cl,r.cP)
+            else:
+                x=memo_fb(cl,r.cW,M[r.i][1])
             if x:
-                X[i]=x
+                X[r.i]=x
                 p+=2
                 ec[2]+=1
                 continue
@@ -1033,25 +2369,79 @@ def find_bc(l,templ,bcr,cl,ctempl,cbcr):
         break
     return X,p,ec
 
-def fb(l,templ,i,bcr):
-    r=''
-    x=[k.start()+i-bcr[i][-3] for k in regex.finditer(templ[bcr[i][-3]:i],l,overlapped=True)]### update !!!
-    if x:
-        y=[k.start() for k in regex.finditer(templ[bcr[i][-2]:bcr[i][-1]],l,overlapped=True)]### update !!!
-        z=[(n,m) for n in x for m in y if m>n and m-n==bcr[i][0]]
-        if z:
-            if len(z)==1:
-                z=z[0]
-            else:
-                q=min([abs(k[0]-i) for k in z])
-                w=[k for k in z if abs(k[0]-i)==q]
-                if len(w)==1:
-                    z=w[0]
+def regions(templ,bcr,ctempl,cbcr):
+    R=[]
+    P=probes(templ,bcr)
+    cP=probes(ctempl,cbcr)
+    x=list(cbcr)
+    for k,i in enumerate(bcr):
+        a,b,c=bcr[i][-3:]
+        y=[False]+[None]*8
+        if bcr[i][2]:
+            j=x[k]
+            d,e,f=cbcr[j][-3:]
+            y=[True,j,d,e,f,ctempl[d:j],ctempl[e:f],cP[j],window(cP[j])]
+        R.append(Region(i,a,b,c,templ[a:i],templ[b:c],P[i],window(P[i]),*y))
+    return tuple(R)
+
+def window(P):
+    x,y,s,n,i,lo,hi=P
+    d=max(i-lo,hi-i)
+    a=max(0,i-d-s)
+    return a,i+d+n+len(y),(x,y,s,n,i-a,lo-a,hi-a)
+
+def probes(templ,bcr):
+    P={}
+    for i in bcr:
+        a,b,c=bcr[i][-3:]
+        P[i]=(templ[a:i],templ[b:c],i-a,bcr[i][0],i,round(i*0.9)-2,round(i*1.1)+2)
+    return P
+
+def fb(l,P):
+    x,y,s,n,i,lo,hi=P
+    z=None
+    d=-1
+    q,o,u,v=x,s,y,n
+    if len(y)>len(x):
+        q,o,u,v=y,-n,x,-s
+    k=l.find(q,max(0,-o-v))
+    while k!=-1:
+        j=k+o
+        if l.startswith(u,j+v):
+            if d==-1 or abs(j-i)<d:
+                z=j
+                d=abs(j-i)
+            elif abs(j-i)==d:
+                z=None
+        k=l.find(q,k+1)
+    if z is not None and lo<=z<=hi:
+        return l[z:z+n]
+    return ''
+
+def memo_fb(l,W,M):
+    a,b,P=W
+    w=l[a:b]
+    x=M.get(w)
+    if x is None:
+        x=fb(w,P)
+        M.put(w,x)
+    return x
+
+def neighbours(seqs):
+    x={}
+    for n in seqs:
+        for i in range(len(n)):
+            for m in 'atgc'+dbl.ambiguous:
+                if m==n[i]:
+                    continue
+                y=n[:i]+m+n[i+1:]
+                if y in seqs:
+                    continue
+                if y in x and x[y]!=n:
+                    x[y]=None
                 else:
-                    z=None
-            if z and round(i*0.9)-2<=z[0]<=round(i*1.1)+2:
-                r=l[z[0]:z[1]]
-    return r
+                    x[y]=n
+    return x
 
 def maxmatch(sample,target,probe):
     a=b=x=y=w=z=0
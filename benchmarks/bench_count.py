@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# Throughput benchmark of barseqcount count on synthetic reads
+import argparse,contextlib,cProfile,io,json,os,pstats,resource,shutil,subprocess,sys,tempfile,time
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','barseqcount'))
+import barseqcount as bsc
+from synth import synth
+
+scenarios={
+    'clean':dict(subst=0,indel=0,shift=0,unknown=0),
+    'substitutions':dict(subst=0.2,indel=0,shift=0,unknown=0.01),
+    'indels':dict(subst=0,indel=0.2,shift=0,unknown=0.01),
+    'shifts':dict(subst=0,indel=0,shift=0.2,unknown=0.01),
+    'mixed':dict(subst=0.05,indel=0.05,shift=0.03,unknown=0.01)}
+
+def main():
+    parser=argparse.ArgumentParser(description="Measures reads per second, peak memory and time spent in each stage of barseqcount count on synthetic reads")
+    parser.add_argument('-n','--reads',type=int,default=200000,help="Number of reads per scenario (default: 200000)")
+    parser.add_argument('-s','--scenarios',nargs='+',default=list(scenarios),choices=list(scenarios),help="Scenarios to run (default: all)")
+    parser.add_argument('-f','--format',default='fq.gz',help="Read file extension (default: fq.gz)")
+    parser.add_argument('-j','--json',default='',help="Save results into this JSON file")
+    parser.add_argument('--no-stages',dest='stages',default=True,action='store_false',help="Skip the profiled run measuring time spent in each stage")
+    parser.add_argument('--keep',default='',help="Keep generated files in this directory instead of a temporary directory")
+    parser.add_argument('--run',help=argparse.SUPPRESS)
+    parser.add_argument('--profile',help=argparse.SUPPRESS)
+    args,extra=parser.parse_known_args()
+    if args.run:
+        print(json.dumps(run(args.run,extra)))
+        return
+    if args.profile:
+        print(json.dumps(profile(args.profile,extra)))
+        return
+    d=args.keep or tempfile.mkdtemp()
+    os.makedirs(d,exist_ok=True)
+    results={'version':bsc.__version__,'python':sys.version.split()[0],'reads':args.reads,'options':extra,'scenarios':{}}
+    print('\n  barseqcount '+bsc.__version__+', '+format(args.reads,',')+' reads per scenario, count options: '+(' '.join(extra) or 'none'))
+    print('\n  '+'Scenario'.ljust(14)+'Reads/s'.rjust(10)+'RSS (MB)'.rjust(10)+'find_bc'.rjust(9)+'fb'.rjust(9)+'correct'.rjust(9)+'mapping'.rjust(9))
+    for n in args.scenarios:
+        os.chdir(d)
+        conf=synth(n,args.reads,args.format,**scenarios[n])[0]
+        x=child('--run',conf,extra)
+        if args.stages:
+            x.update(child('--profile',conf,extra))
+        x['reads_per_s']=args.reads/x['time']
+        results['scenarios'][n]=x
+        y=[format(x[k],'.2f') if k in x else '-' for k in ('find_bc','fb','correction','mapping')]
+        print('  '+n.ljust(14)+format(round(x['reads_per_s']),',').rjust(10)+format(x['rss']/1048576,'.1f').rjust(10)+''.join([k.rjust(9) for k in y]))
+    if args.stages:
+        print('\n  Stage times are in seconds, from a separate profiled run.')
+    if not args.keep:
+        os.chdir('/')
+        shutil.rmtree(d)
+    if args.json:
+        with open(args.json,'w') as f:
+            json.dump(results,f,indent=2)
+        print('\n  Results saved into file: '+args.json)
+    print()
+
+def child(mode,conf,extra):
+    x=subprocess.run([sys.executable,os.path.abspath(__file__),mode,conf]+extra,stdout=subprocess.PIPE,check=True)
+    return json.loads(x.stdout.decode().strip().split('\n')[-1])
+
+def count(conf,extra):
+    sys.argv=['barseqcount','count','-c',conf,'-k','0']+extra
+    with contextlib.redirect_stdout(io.StringIO()):
+        bsc.main()
+
+def rss():
+    x=max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    if sys.platform!='darwin':
+        x*=1024
+    return x
+
+def run(conf,extra):
+    t=time.perf_counter()
+    count(conf,extra)
+    return {'time':time.perf_counter()-t,'rss':rss()}
+
+def profile(conf,extra):
+    extra=[extra[i] for i in range(len(extra)) if extra[i] not in ('-t','--threads','--workers') and (not i or extra[i-1] not in ('-t','--threads','--workers'))]
+    p=cProfile.Profile()
+    p.enable()
+    count(conf,extra+['-t','1','-p'])
+    p.disable()
+    s=pstats.Stats(p).stats
+    x={'find_bc':0,'fb':0}
+    for k in s:
+        if k[0].endswith('barseqcount.py') and k[2] in ('find_bc','fb','map_counts','count_reads','batch_decode'):
+            x[k[2]]=x.get(k[2],0)+s[k][3]
+    x['mapping']=x.pop('map_counts',0)
+    with open(conf[:-5]+'_profile.json') as f:
+        y=json.load(f)['stages']
+    x['correction']=y.get('Substitution correction',{'time':0})['time']
+    return x
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+# Startup time of barseqcount commands, with NumPy and matplotlib loaded lazily or eagerly
+import argparse,os,shutil,statistics,subprocess,sys,tempfile,time
+bsc=os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','barseqcount','barseqcount.py')
+eager="import sys,runpy,numpy,matplotlib.pyplot;sys.argv=sys.argv[1:];runpy.run_path(sys.argv[0],run_name='__main__')"
+check="import sys,runpy;sys.argv=sys.argv[1:];runpy.run_path(sys.argv[0],run_name='__main__');sys.exit(3*('numpy' in sys.modules))"
+
+def main():
+    parser=argparse.ArgumentParser(description="Measures the startup time of barseqcount commands that do not need NumPy or matplotlib, compared with the time when both are imported at startup, and checks that barseqcount count does not import NumPy")
+    parser.add_argument('-r','--repeats',type=int,default=10,help="Number of runs of each command, the median time is reported (default: 10)")
+    args=parser.parse_args()
+    print('\n  '+'Command'.ljust(26)+'Lazy (s)'.rjust(10)+'Eager (s)'.rjust(11))
+    for n in (['-v'],['--help'],['count','--help'],['analyze','--help']):
+        x=timing([sys.executable,bsc]+n,args.repeats)
+        y=timing([sys.executable,'-c',eager,bsc]+n,args.repeats)
+        print('  '+('barseqcount '+' '.join(n)).ljust(26)+format(x,'.3f').rjust(10)+format(y,'.3f').rjust(11))
+    x=count_numpy()
+    print('\n  barseqcount count (synthetic reads) imports NumPy: '+('yes' if x else 'no')+'\n')
+    if x:
+        sys.exit(1)
+
+def count_numpy():
+    from synth import synth
+    d=tempfile.mkdtemp()
+    os.chdir(d)
+    conf=synth('startup',1000,'fq')[0]
+    x=subprocess.run([sys.executable,'-c',check,bsc,'count','-c',conf,'-k','0'],stdout=subprocess.DEVNULL)
+    os.chdir('/')
+    shutil.rmtree(d)
+    if x.returncode not in (0,3):
+        x.check_returncode()
+    return x.returncode==3
+
+def timing(cmd,n):
+    x=[]
+    for i in range(n):
+        t=time.perf_counter()
+        subprocess.run(cmd,stdout=subprocess.DEVNULL,check=True)
+        x.append(time.perf_counter()-t)
+    return statistics.median(x)
+
+if __name__ == '__main__':
+    main()
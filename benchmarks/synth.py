@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# Synthetic amplicon read generator for barseqcount benchmarks
+import argparse,gzip,random
+
+def main():
+    parser=argparse.ArgumentParser(description="Writes a barseqcount count configuration file and synthetic merged reads (FASTQ or FASTA, optionally gzipped)")
+    parser.add_argument('prefix',help="Project name (configuration file: prefix_count.conf, read file: prefix followed by the extension)")
+    parser.add_argument('-n','--reads',type=int,default=100000,help="Number of reads (default: 100000)")
+    parser.add_argument('-f','--format',default='fq.gz',help="Read file extension: fq, fastq, fa, fasta, optionally followed by .gz (default: fq.gz)")
+    parser.add_argument('-b','--barcodes',type=int,nargs=3,default=[4,4,24],metavar=('F','R','V'),help="Number of forward primer barcodes, reverse primer barcodes and variant barcodes (default: 4 4 24)")
+    parser.add_argument('-l','--length',type=int,default=8,help="Variant barcode length (default: 8)")
+    parser.add_argument('-s','--substitutions',type=float,default=0.05,help="Fraction of reads with a substitution in the variant barcode (default: 0.05)")
+    parser.add_argument('-i','--indels',type=float,default=0.05,help="Fraction of reads with a homopolymer insertion or deletion outside barcodes (default: 0.05)")
+    parser.add_argument('-p','--shifts',type=float,default=0.03,help="Fraction of reads with extra bases before the forward primer (default: 0.03)")
+    parser.add_argument('-u','--unknown',type=float,default=0.01,help="Fraction of reads with an unknown variant barcode (default: 0.01)")
+    parser.add_argument('-r','--reverse',type=float,default=0.5,help="Fraction of reads in reverse orientation (default: 0.5)")
+    parser.add_argument('-e','--seed',type=int,default=1,help="Random seed (default: 1)")
+    args=parser.parse_args()
+    synth(args.prefix,args.reads,args.format,args.barcodes,args.length,args.substitutions,args.indels,args.shifts,args.unknown,args.reverse,args.seed)
+
+def synth(prefix,n,fmt='fq.gz',nb=(4,4,24),lv=8,subst=0.05,indel=0.05,shift=0.03,unknown=0.01,rev=0.5,seed=1):
+    random.seed(seed)
+    Fb=rseq(20)
+    Rb=rseq(20)
+    F=barcodes(nb[0],6)
+    R=barcodes(nb[1],6)
+    V=barcodes(nb[2],lv,Fb[-1])
+    rfile=prefix+'.'+fmt
+    c='=== BARSEQCOUNT COUNT CONFIGURATION FILE ===\n\n# PROJECT NAME\n\n'+prefix+'\n\n# READ FILE(S)\n\n'+rfile+'\n\n# TEMPLATE SEQUENCE\n\n'+Fb+'n'*lv+Rb+'\n\n# PRIMERS/BARCODES\n\n'
+    for i in range(len(F)):
+        c+='F'+str(i+1)+' '+F[i]+Fb+'\n'
+    for i in range(len(R)):
+        c+='R'+str(i+1)+' cg'+R[i]+rc(Rb)+'\n'
+    c+='\n'
+    for i in range(len(V)):
+        c+='V'+str(i+1)+' '+Fb[-10:]+V[i]+Rb[:10]+'\n'
+    c+='\n# DEFINITIONS\n\n'
+    for i in range(len(F)):
+        for j in range(len(R)):
+            c+='S'+str(i+1)+'-'+str(j+1)+' F'+str(i+1)+' R'+str(j+1)+'\n'
+    for i in range(len(V)):
+        c+='AAV'+str(i+1)+' V'+str(i+1)+'\n'
+    c+='\n# PROBE LENGTH\n\n5\n\n=== END OF CONFIGURATION FILE ===\n'
+    with open(prefix+'_count.conf','w') as f:
+        f.write(c)
+    op=open
+    if fmt.endswith('.gz'):
+        op=gzip.open
+    fq=fmt.replace('.gz','') in ('fq','fastq')
+    a=len(F[0])+len(Fb)
+    with op(rfile,'wt') as f:
+        for k in range(n):
+            v=random.choice(V)
+            if random.random()<unknown:
+                v=rseq(lv)
+            s=random.choice(F)+Fb+v+Rb+rc(random.choice(R))+'cg'
+            if random.random()<subst:
+                i=a+random.randrange(lv)
+                s=s[:i]+random.choice([x for x in 'acgt' if x!=s[i]])+s[i+1:]
+            if random.random()<indel:
+                x=[i for i in list(range(8,a-1))+list(range(a+lv,len(s)-8)) if s[i]==s[i+1]]
+                if x:
+                    i=random.choice(x)
+                    s=s[:i]+random.choice((s[i],''))+s[i+1:]
+            if random.random()<shift:
+                s=rseq(random.randint(1,3))+s
+            if random.random()<rev:
+                s=rc(s)
+            s=s.upper()
+            if fq:
+                f.write('@r'+str(k)+'\n'+s+'\n+\n'+'I'*len(s)+'\n')
+            else:
+                f.write('>r'+str(k)+'\n'+s+'\n')
+    return prefix+'_count.conf',rfile
+
+def rseq(n):
+    return ''.join([random.choice('acgt') for i in range(n)])
+
+def rc(seq):
+    return seq[::-1].translate(str.maketrans('acgt','tgca'))
+
+def barcodes(n,l,prev=''):
+    x=[]
+    while len(x)<n:
+        s=rseq(l)
+        if s[0]!=prev and all([s[i]!=s[i+1] for i in range(l-1)]) and all([sum([s[i]!=k[i] for i in range(l)])>2 for k in x]):
+            x.append(s)
+    return x
+
+if __name__ == '__main__':
+    main()
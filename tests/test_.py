@@ -1,15 +1,262 @@
 #!/usr/bin/env python
-import pytest
+import pytest,pickle
+from array import array
 bsc=__import__('barseqcount')
 
 def test_maxmatch():
     assert bsc.maxmatch('gtcaaagcttag','aaacggtcaaagctgtaggcaacatgtcag',5)==(0,0,9,5)
 
+def test_neighbours():
+    x=bsc.neighbours({'acgtac':'b1','tgcatg':'b2'})
+    assert x['acgtaa']=='acgtac' and x['tgnatg']=='tgcatg' and 'acgtac' not in x and 'acgaaa' not in x
+    assert bsc.neighbours({'aaa':'b1','aat':'b2'})['aag'] is None
+
+def test_pack():
+    assert bsc.pack('acgt')==int('10123',4) and bsc.unpack(bsc.pack('gattaca'))=='gattaca'
+    assert bsc.pack('acnt')=='acnt' and bsc.unpack('acnt')=='acnt' and bsc.pack('a')!=bsc.pack('aa')
+
+def test_counts():
+    a=bsc.Counts()
+    b=bsc.Counts()
+    a.add(5)
+    a.add(3,2)
+    b.add(7)
+    b.add(3)
+    a.merge(b)
+    assert list(a.items())==[(5,1),(3,3),(7,1)]
+
 def test_fb():
-    assert bsc.fb('tactgcagcttcgtacgggttacct','tactnnnnnttcgtacgggttacct',4,{4:[5,0,9,14]})=='gcagc'
+    assert bsc.fb('tactgcagcttcgtacgggttacct',bsc.probes('tactnnnnnttcgtacgggttacct',{4:[5,0,9,14]})[4])=='gcagc'
 
 def test_find_bc():
-    assert bsc.find_bc('tactgcagcttcgtacgggttacct','tactnnnnnttcgtacgggttacct',{4:[5,0,9,14]},'tactgcagctcgtacgtact','tactnnnnntcgtacgtact',{4:[5,0,9,14]})==({4: 'gcagc'}, 0, [0, 0, 0])
+    R=bsc.regions('tactnnnnnttcgtacgggttacct',{4:[5,True,True,0,9,14]},'tactnnnnntcgtacgtact',{4:[5,0,9,14]})
+    assert R[0].left=='tact' and R[0].right=='ttcgt' and R[0].cright=='tcgta'
+    assert bsc.find_bc('tactgcagcttcgtacgggttacct','tactgcagctcgtacgtact',R)==({4: 'gcagc'}, 0, [0, 0, 0])
+    assert bsc.find_bc('tactgcagcttttcgtacgggttacct','tactgcagctcgtacgtact',R)==({4: 'gcagc'}, 1, [0, 1, 0])
 
-pytest.main()
+def test_stream_open(tmp_path):
+    x=tmp_path/'r.fa'
+    x.write_text('>r1\nACGT\n>r2\nTTGA\n')
+    f,step=bsc.stream_open(str(x))
+    assert step==2
+    assert [bsc.dbl.getread(f,step,0)[0] for i in range(3)]==['acgt','ttga','']
+    f.close()
+
+def test_mmap_reads(tmp_path):
+    x=tmp_path/'r.fq'
+    x.write_text('@r1\nACGT\n+\n@III\n@r2\nTTGA\n+\n@@II\n@r3\nGGCA\n+\nIIII\n')
+    assert bsc.record_start(bsc.mmap_open(str(x)),5,4)==16
+    y=[bsc.mmap_reads(*k) for k in bsc.mmap_chunks(str(x),4,'',0,1)]
+    bsc.mmap_close(str(x))
+    assert y==[['acgt'],['ttga'],['ggca']]
+    assert bsc.parse_reads(b'>r1\r\nAC\r\nGT\r\n>r2\r\nTTGA\r\n',0)==['acgt','ttga']
+
+def test_gz_blocks(tmp_path):
+    import gzip,struct,zlib
+    x=b''.join([b'@r%d\nACGT\n+\nIIII\n'%i for i in range(1000)])
+    y=b''
+    for i in range(0,len(x),5000):
+        c=zlib.compressobj(6,zlib.DEFLATED,-15)
+        z=c.compress(x[i:i+5000])+c.flush()
+        y+=b'\x1f\x8b\x08\x04\0\0\0\0\0\xff\x06\0BC\x02\0'+struct.pack('<H',len(z)+25)+z+struct.pack('<II',zlib.crc32(x[i:i+5000]),len(x[i:i+5000]))
+    for n,m in ((y,x),(gzip.compress(x)+gzip.compress(x),x+x)):
+        (tmp_path/'r.fq.gz').write_bytes(n)
+        with open(tmp_path/'r.fq.gz','rb') as f:
+            assert b''.join(bsc.gz_blocks(f))==m
+        assert sum([k for k in bsc.gz_chunks(str(tmp_path/'r.fq.gz'),4,'',0,100)],[])==['acgt']*(len(m)//len(x)*1000)
+
+def test_lru():
+    x=bsc.LRU(800,(),300)
+    x.put('a',1)
+    x.put('b',2)
+    assert x.get('a')==1
+    x.put('c',3)
+    assert x.get('b') is None and x.get('a')==1 and len(x)==2 and x.peak==x.mem
+    assert bsc.lru('t',800,'+') is bsc.lru('t',800,'+') and bsc.lru('t',800,'-') is not bsc.lru('t',800,'+')
+
+def test_count_reads_dedup():
+    R=bsc.regions('tactnnnnnttcgtacgggttacct',{4:[5,True,False,0,9,14]},'',{})
+    S=('tactnnnnnttcgtacgggttacct',R,None,[{bsc.pack('gcagc'):'b1'}],[{bsc.pack('gcagg'):bsc.pack('gcagc')}],[0,12])
+    x=['tactgcagcttcgtacgggttacct','tactgcaggttcgtacgggttacct','aaaaaaaaaaaa']*3
+    bsc._lru.clear()
+    a=bsc.count_reads(x,'+',S)
+    b=bsc.count_reads(x,'+',S,dedup=10000)
+    assert list(a[0].items())==list(b[0].items()) and a[1][:7]==b[1][:7] and a[2]==b[2]==6
+    assert b[1][7:9]==[6,9]
+
+def test_memo_fb():
+    R=bsc.regions('tactnnnnnttcgtacgggttacct',{4:[5,True,True,0,9,14]},'tactnnnnntcgtacgtact',{4:[5,0,9,14]})
+    M={4:(bsc.LRU(10000),bsc.LRU(10000))}
+    for i in range(2):
+        assert bsc.find_bc('gtactgcagcttcgtacgggttacct','gtactgcagctcgtacgtact',R,M)==({4: 'gcagc'}, 1, [1, 0, 0])
+    assert (M[4][0].hits,M[4][0].n,M[4][1].n)==(1,2,0)
+
+def test_merge(tmp_path,monkeypatch):
+    import argparse
+    monkeypatch.chdir(tmp_path)
+    a,b=bsc.pack('gcagc'),bsc.pack('ttaca')
+    for i in range(2):
+        x={'shard':1,'digest':'x','project':'p','settings':'','map':([4],[0,12],[{a:'b1',b:'b2'}],[(4,)],{(4,):{(a,):'v1'}}),'DEF':{(4,):{('b1',):'v1'}},'dedup':0,'memo':0}
+        x['files']=[['s1','s1.fq',100,'+',[a,b],[0,0,0,0,0,90,0,0,0,0,0,0,0],90]]
+        bsc.data_save('s%d.bsq'%i,x,{'0':array('q',[60+i,30])})
+    with open('s2.bsq','wb') as f:
+        pickle.dump(x,f)
+    bsc.merge(argparse.Namespace(shards=['s0.bsq','s1.bsq'],project=''))
+    assert open('p_count.csv').read()=='v1,121\nb2,60\n' and '180 ( 90.00% of total reads)' in open('p_count_report.txt').read()
+    with pytest.raises(SystemExit):
+        bsc.merge(argparse.Namespace(shards=['s0.bsq','s2.bsq'],project=''))
+
+def test_spool_worker(tmp_path):
+    R=bsc.regions('tactnnnnnttcgtacgggttacct',{4:[5,True,False,0,9,14]},'',{})
+    x=tmp_path/'r.fa'
+    x.write_text('>r1\ntactgcagcttcgtacgggttacct\n>r2\ntactgcaggttcgtacgggttacct\n>r3\naaaaaaaaaaaa\n')
+    for n in ('tasks','claimed','results'):
+        (tmp_path/n).mkdir()
+    bsc.data_save(str(tmp_path/'settings.bsq'),{'digest':'x','settings':('tactnnnnnttcgtacgggttacct',tuple([tuple(k) for k in R]),None,[{bsc.pack('gcagc'):'b1'}],[{bsc.pack('gcagg'):bsc.pack('gcagc')}],[0,12]),'batch':0,'dedup':0,'memo':0})
+    for i,r in enumerate(((0,30),(30,len(x.read_bytes())))):
+        bsc.data_save(str(tmp_path/'tasks'/('%d.bsq'%i)),{'digest':'x','file':str(x),'range':r,'step':2,'ori':'+'})
+    assert bsc.spool_worker(str(tmp_path),quiet=False)==2 and not list((tmp_path/'claimed').iterdir())
+    y,A=bsc.data_load(str(tmp_path/'results'/'1.bsq'))
+    assert (y['reads'],y['successful'],y['keys'],list(A['n']))==(2,1,[bsc.pack('gcagc')],[1])
+
+def test_data_save(tmp_path):
+    x={'a':(1,'b',None,[2.5,True]),(3,4):{1<<100:(5,'c')}}
+    bsc.data_save(str(tmp_path/'x.bsq'),x,{'n':array('q',[1,-2]),'m':array('B',[3])})
+    y,A=bsc.data_load(str(tmp_path/'x.bsq'))
+    assert y==x and type(y['a']) is tuple and list(A['n'])==[1,-2] and list(A['m'])==[3]
+    (tmp_path/'y.bsq').write_bytes(pickle.dumps(x))
+    with pytest.raises(ValueError):
+        bsc.data_load(str(tmp_path/'y.bsq'))
 
+def test_spool_requeue(tmp_path,monkeypatch):
+    import os,sys,time,subprocess
+    monkeypatch.chdir(tmp_path)
+    x='=== BARSEQCOUNT COUNT CONFIGURATION FILE ===\n\n# PROJECT NAME\n\np\n\n# READ FILE(S)\n\np.fq\n\n# TEMPLATE SEQUENCE\n\ncagattttcatattatgcagnnnnnnnnaaaatctacttcgcctgata\n\n# PRIMERS/BARCODES\n\n'
+    x+='F1 cgagtccagattttcatattatgcag\nR1 cggtgtcgtatcaggcgaagtagatttt\n\nV1 tattatgcagcgcgtcgaaaaatctact\n\n# DEFINITIONS\n\nS1 F1 R1\nAAV1 V1\n\n# PROBE LENGTH\n\n5\n\n=== END OF CONFIGURATION FILE ===\n'
+    (tmp_path/'p_count.conf').write_text(x)
+    x='cgagtccagattttcatattatgcagcgcgtcgaaaaatctacttcgcctgatacgacaccg'
+    (tmp_path/'p.fq').write_text(''.join(['@r%d\n%s\n+\n%s\n'%(i,x,'I'*len(x)) for i in range(101)]))
+    def wait(f):
+        for i in range(600):
+            if f():
+                return True
+            time.sleep(0.05)
+    cmd=[sys.executable,bsc.__file__,'count','-c','p_count.conf','--spool','sp','-t','0','--task_size','0.008']
+    c=subprocess.Popen(cmd,stdout=subprocess.PIPE,stderr=subprocess.STDOUT)
+    assert wait(lambda:os.path.isdir('sp/tasks') and len(os.listdir('sp/tasks'))==2)
+    x="import sys,time;sys.path.insert(0,%r);import barseqcount as bsc;f=bsc.range_count;bsc.range_count=lambda *a:(time.sleep(60),f(*a))[1];bsc.spool_worker('sp')"%os.path.dirname(bsc.__file__)
+    w=subprocess.Popen([sys.executable,'-c',x],stdout=subprocess.DEVNULL)
+    assert wait(lambda:os.listdir('sp/claimed'))
+    w.kill()
+    w.wait()
+    assert wait(lambda:not os.listdir('sp/claimed') and len(os.listdir('sp/tasks'))==2)
+    subprocess.run([sys.executable,bsc.__file__,'worker','sp'],capture_output=True,check=True)
+    c.wait(60)
+    assert open('p_count.csv').read()=='S1,AAV1,101\n'
+    c=subprocess.Popen(cmd,stdout=subprocess.PIPE,stderr=subprocess.STDOUT)
+    assert wait(lambda:os.path.isdir('sp/tasks') and len(os.listdir('sp/tasks'))==2)
+    for n in os.listdir('sp/tasks'):
+        os.remove(os.path.join('sp/tasks',n))
+    assert 'run the same command again' in c.communicate(timeout=60)[0].decode().lower()
+
+def test_others():
+    import numpy as np
+    x=np.array([[1.,5,2,3],[3.,1,2,4]])
+    V,y=bsc.others(2,x.mean(axis=0),['a','b','c','d'],x)
+    assert V==['b','d','others'] and y.tolist()==[[5,3,1.5],[1,4,2.5]]
+    assert bsc.others(3,x[0],['a','b','c','d'],x)[1] is x
+
+def test_figures_cache(tmp_path,monkeypatch,capsys):
+    monkeypatch.chdir(tmp_path)
+    for i in range(2):
+        bsc.figures([('csv',('a.csv',['x'],[[1,2]],None,'A',None)),('csv',('b.csv',['y'],[[i,3]],None,'B',None))],None,None,1,'cc')
+    assert capsys.readouterr().out.endswith('1 of 2 figures and csv files were unchanged and copied from cache directory cc\n')
+    assert open('a.csv').read()=='x,1,2\n' and open('b.csv').read()=='y,1,3\n' and len(list((tmp_path/'cc').iterdir()))==3
+
+def test_count_bin(tmp_path,monkeypatch):
+    import os
+    monkeypatch.chdir(tmp_path)
+    x={'s1,v1,a':5,'s1,v2':300,'s2,v1,b':7}
+    bsc.dbl.csv_write('p_count.csv',None,x,None,None,None)
+    bsc.count_bin('p_count.csv',x,{'tlen':20,'defn':[[[4],'v1']],'rfp':['s1','s2']})
+    a=bsc.count_table('p_count.csv')
+    assert a[0]==['s1','v1','a','v2','s2','b'] and a[1].tolist()==[0,1,2,0,3,4,1,5] and a[2].tolist()==[0,3,5,8] and a[3].tolist()==[5,300,7]
+    assert bsc.load_bin('p_count.bsq')[1]['rfp']==['s1','s2'] and bsc.load_bin('p_count.bsq')[0]['counts'].typecode=='H'
+    os.utime('p_count.csv',ns=(0,0))
+    b=bsc.count_table('p_count.csv')
+    assert bsc.load_bin('p_count.bsq') is None and b[0]==a[0] and all((i==j).all() for i,j in zip(a[1:],b[1:]))
+
+def test_count_reads_n():
+    t='tactnnnnnttcgtacgggttacctgcatgnnnnnagtcaggact'
+    R=bsc.regions(t,{4:[5,True,False,0,9,14],30:[5,True,False,25,35,40]},'',{})
+    S=(t,R,None,[{bsc.pack('gcagc'):'b1'},{bsc.pack('aaccg'):'c1'}],[{},{}],[0,12,24])
+    x=['tactgcngcttcgtacgggttacctgcatgaaccgagtcaggact','tactgcagcttcgtacgggttacctgcatgaaccgagtcaggact']
+    for b in (False,True):
+        assert list(bsc.count_reads(x,'+',S,batch=b)[0].items())==[(('gcngc',bsc.pack('aaccg')),1),(bsc.pack('gcagc')|bsc.pack('aaccg')<<12,1)]
+
+def test_count_profile(tmp_path,monkeypatch):
+    import os,sys,json,subprocess
+    monkeypatch.chdir(tmp_path)
+    x='=== BARSEQCOUNT COUNT CONFIGURATION FILE ===\n\n# PROJECT NAME\n\np\n\n# READ FILE(S)\n\np.fq\n\n# TEMPLATE SEQUENCE\n\ncagattttcatattatgcagnnnnnnnnaaaatctacttcgcctgata\n\n# PRIMERS/BARCODES\n\n'
+    x+='F1 cgagtccagattttcatattatgcag\nR1 cggtgtcgtatcaggcgaagtagatttt\n\nV1 tattatgcagcgcgtcgaaaaatctact\n\n# DEFINITIONS\n\nS1 F1 R1\nAAV1 V1\n\n# PROBE LENGTH\n\n5\n\n=== END OF CONFIGURATION FILE ===\n'
+    (tmp_path/'p_count.conf').write_text(x)
+    x='cgagtccagattttcatattatgcagcgcgtcgaaaaatctacttcgcctgatacgacaccg'
+    (tmp_path/'p.fq').write_text(''.join(['@r%d\n%s\n+\n%s\n'%(i,k,'I'*len(k)) for i,k in enumerate([x]*100+['ag'+x])]))
+    for t in ('1','2'):
+        subprocess.run([sys.executable,bsc.__file__,'count','-c','p_count.conf','-p','-t',t],capture_output=True,check=True)
+        assert {'Exact match','Alternate position','Merging'}<=set(json.load(open('p_count_profile.json'))['stages'])
+    assert open('p_count.csv').read()=='S1,AAV1,101\n'
+    y="import sys,runpy;sys.argv=%r;runpy.run_path(sys.argv[0],run_name='__main__');assert 'numpy' not in sys.modules"%[bsc.__file__,'count','-c','p_count.conf']
+    subprocess.run([sys.executable,'-c',y],capture_output=True,check=True)
+    assert bsc.count_table('p_count.csv')[0]==['S1','AAV1'] and os.path.isfile('p_count.bsq')
+    subprocess.run([sys.executable,bsc.__file__,'count','-c','p_count.conf','-s'],capture_output=True,check=True)
+    assert os.path.isfile('p_count_shard.bsq')
+    (tmp_path/'p.fq').write_text(''.join(['@r%d\n%s\n+\n%s\n'%(i,x,'I'*len(x)) for i in range(50)]))
+    subprocess.run([sys.executable,bsc.__file__,'count','-c','p_count.conf','-s'],capture_output=True)
+    assert not os.path.isfile('p_count_shard.bsq') and 'too low' in open('p_count_report.txt').read()
+
+def test_import_deferred(tmp_path):
+    import os,sys,subprocess
+    (tmp_path/'p_count.csv').write_text('S1,AAV1,101\n')
+    x="import sys;sys.path.insert(0,%r);import barseqcount as bsc,dmbiolib;assert 'numpy' not in sys.modules and isinstance(dmbiolib.np,bsc.Lazy);bsc.count_table('p_count.csv');assert dmbiolib.np.arange(3).sum()==3 and dmbiolib.np is sys.modules['numpy'] and not isinstance(dmbiolib.np,bsc.Lazy)"%os.path.dirname(bsc.__file__)
+    subprocess.run([sys.executable,'-c',x],cwd=tmp_path,check=True)
+
+def test_file_id(tmp_path):
+    import os
+    x=tmp_path/'r.fa'
+    x.write_text('>r1\nACGT\n')
+    a=bsc.file_id(str(x))
+    x.write_text('>r1\nACGTT\n')
+    os.utime(x,ns=(1,1))
+    assert a[0]==9 and bsc.file_id(str(x))==(10,1) and bsc.file_id('-')==()
+
+def test_file_hash(tmp_path):
+    import os,pickle
+    x,y=tmp_path/'a.fa',tmp_path/'b.fa'
+    x.write_text('>r1\nACGT\n')
+    y.write_text('>r1\nACGA\n')
+    c=str(tmp_path/'c')
+    a=bsc.file_hash(str(x),c)
+    bsc.file_hash(str(y),c)
+    x.write_text('>r1\nACGTT\n')
+    os.remove(y)
+    assert bsc.file_hash(str(x),c)!=a
+    with open(os.path.join(c,'hashes.pkl'),'rb') as f:
+        z=pickle.load(f)
+    assert list(z)==[(str(x),)+bsc.file_id(str(x))]
+
+def test_batch_decode():
+    c=lambda x:x[::-1].translate(str.maketrans('acgtn','tgcan'))
+    r='tactgcagcttcgtacgggttacctgcatgaaccgagtcaggact'
+    b='acgtacgtacgtacgtacgtacgtacgtacgtac'
+    for t,bcr,BC,sh,x in (('tactnnnnnttcgtacgggttacctgcatgnnnnnagtcaggact',{4:[5,True,False,0,9,14],30:[5,True,False,25,35,40]},[{bsc.pack('gcagc'):'b1'},{bsc.pack('aaccg'):'c1'}],[0,12,24],[r,r.replace('gcagc','gcngc'),r[:30],r.replace('gcagc','ttttt'),r,'ga'+r,r+'tt',r.replace('aaccg','aacng')]),
+                          ('tactg'+'n'*34+'ttcgtacggg',{5:[34,True,False,0,39,44]},[{bsc.pack(b):'b1'}],[0,70],['tactg'+b+'ttcgtacggg']*2+['tactg'+b[:5]+'n'+b[6:]+'ttcgtacggg','tactg'+'ac'*17+'ttcgtacggg','tactg'+b[:15]])):
+        R=bsc.regions(t,bcr,'',{})
+        for ori,y in (('+',x),('-',[c(k) for k in x]),('Both',[c(k) if i%2 else k for i,k in enumerate(x)])):
+            S=(t,R,bsc.strand_signature(t) if ori=='Both' else None,BC,[{}]*len(BC),sh)
+            u=bsc.count_reads(y,ori,S)
+            v=bsc.count_reads(y,ori,S,batch=True)
+            assert list(u[0].items())==list(v[0].items()) and u[1][:7]==v[1][:7] and u[2:4]==v[2:4]
+            assert tuple in [type(k) for k in bsc.batch_decode(y,ori,S)]
+
+pytest.main()